@@ -12,29 +12,42 @@ import pandas as pd
 import numpy as np
 from climate_indices import compute,indices
 import uuid
+import calendar
+import hashlib
+import json
+import netCDF4
 from datetime import date
 import os
 import glob
-from calendar import monthrange
 import sys
 import ast
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 import cartopy.crs as ccrs
 import cartopy.feature as cfeature
+import matplotlib
 import matplotlib.pyplot as plt
 import imageio
 import matplotlib.ticker as mticker
 from cartopy.mpl.gridliner import LONGITUDE_FORMATTER, LATITUDE_FORMATTER
 import matplotlib.cm as cm
+import scipy.special
+import scipy.stats
 
 
 #%% Open files from various agencies
+# LDAS cubes are opened lazily, TIME_CHUNK months at a time
+TIME_CHUNK = 120
+
 ## CHIRPS
-def openCHIRPS(dataset_name, bounding_box):
+def openCHIRPS(dataset_name, bounding_box, dtype=None):
     """ Open CHIRPS dataset and returns the data
 
     Args:
         dataset_name (str): The name of the CHIRPS dataset
         bounding_box (list): lat/lon to cut to appropriate size
+        dtype (str): dtype of the returned data, e.g. 'float32'. Default is the
+            dtype of the file.
 
     Returns:
         da_precip (Xarra DataArray): A dataArray of precipitation
@@ -44,11 +57,138 @@ def openCHIRPS(dataset_name, bounding_box):
     p_ = data.sel(latitude=slice(bounding_box[2], bounding_box[3]),\
                   longitude=slice(bounding_box[0],bounding_box[1]))
     da_precip = p_.precip
+    if dtype is not None:
+        da_precip = da_precip.astype(dtype)
     #da_precip_groupby = da_precip.stack(point=('latitude', 'longitude')).groupby('point')
 
     return da_precip
 
-def openGLDAS(dataset_name, bounding_box, periodicity, netcdf):
+## LDAS folders
+def catalogFile(dataset_name, cache_dir):
+    """Path of the catalog of an LDAS folder in the cache directory"""
+    digest = hashlib.sha1(os.path.abspath(dataset_name).encode()).hexdigest()[:16]
+
+    return os.path.join(cache_dir, 'ldas_catalog_'+digest+'.json')
+
+def ldasCatalog(dataset_name, extension, lat_name, lon_name, cache_dir=None):
+    """Time coverage and grid of the files of an LDAS folder
+
+    The folder contains one subfolder per period (e.g. per year) of files. The
+    catalog is kept in cache_dir, never in the (possibly read-only or shared)
+    data folder, and refreshed incrementally: only the files that are new or
+    were modified since the last run are opened.
+
+    Args:
+        dataset_name (str): The name of the LDAS folder
+        extension (str): extension of the data files ('nc4' or 'nc')
+        lat_name (str): name of the latitude coordinate
+        lon_name (str): name of the longitude coordinate
+        cache_dir (str): directory of the catalog. Default is None (all the
+            files are opened on every run)
+
+    Returns:
+        catalog (dict): for each file (path relative to the folder), its size,
+            modification time, time_start, time_end and grid extent
+    """
+    catalog_file = catalogFile(dataset_name, cache_dir) if cache_dir is not None else None
+    catalog = {}
+    if catalog_file is not None and os.path.isfile(catalog_file):
+        with open(catalog_file) as f:
+            catalog = json.load(f)
+
+    file_names = []
+    subdirs = [os.path.join(dataset_name, o) for o in os.listdir(dataset_name)
+               if os.path.isdir(os.path.join(dataset_name, o))]
+    for path in subdirs:
+        file_names.extend(glob.glob(path+'/*.'+extension))
+
+    updated = {}
+    for file in sorted(file_names):
+        name = os.path.relpath(file, dataset_name)
+        stat = os.stat(file)
+        entry = catalog.get(name)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+            with xr.open_dataset(file) as ds:
+                time = pd.to_datetime(ds.time.values)
+                entry = {'size': stat.st_size,
+                         'mtime': stat.st_mtime,
+                         'time_start': str(time.min().date()),
+                         'time_end': str(time.max().date()),
+                         'lat_min': float(ds[lat_name].min()),
+                         'lat_max': float(ds[lat_name].max()),
+                         'lon_min': float(ds[lon_name].min()),
+                         'lon_max': float(ds[lon_name].max()),
+                         'nlat': int(ds[lat_name].size),
+                         'nlon': int(ds[lon_name].size)}
+        updated[name] = entry
+
+    if catalog_file is not None and updated != catalog:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(catalog_file, 'w') as f:
+                json.dump(updated, f, indent=1)
+        except OSError:
+            print('Cannot write the catalog '+catalog_file+', it will be rebuilt on the next run')
+
+    return updated
+
+def catalogFiles(dataset_name, catalog, years=None, bounding_box=None):
+    """Files of a catalog that overlap the requested years and bounding box
+
+    Args:
+        dataset_name (str): The name of the LDAS folder
+        catalog (dict): catalog returned by ldasCatalog
+        years (list): first and last years needed, None for no limit
+        bounding_box (list): min_lon, max_lon, min_lat, max_lat
+
+    Returns:
+        file_names (list): sorted paths of the files to open
+    """
+    first, last = years if years is not None else (None, None)
+    file_names = []
+    for name, entry in catalog.items():
+        if first is not None and int(entry['time_end'][:4]) < first:
+            continue
+        if last is not None and int(entry['time_start'][:4]) > last:
+            continue
+        if bounding_box is not None and (entry['lon_max'] < bounding_box[0] or
+                                         entry['lon_min'] > bounding_box[1] or
+                                         entry['lat_max'] < bounding_box[2] or
+                                         entry['lat_min'] > bounding_box[3]):
+            continue
+        file_names.append(os.path.join(dataset_name, name))
+
+    return sorted(file_names)
+
+def convertLDASUnits(da_precip, da_temp, dtype=None):
+    """Convert LDAS precipitation to mm/month and temperature to Celsius
+
+    The conversions are broadcast over the (dask) chunks, so nothing is read
+    from disk until the values are needed.
+
+    Args:
+        da_precip (Xarray DataArray): precipitation rate in kg m-2 s-1
+        da_temp (Xarray DataArray): temperature in K
+        dtype (str): dtype of the converted data. Default is the input dtype.
+
+    Returns:
+        da_precip (Xarray DataArray): monthly precipitation in mm
+        da_temp (Xarray DataArray): temperature in C
+    """
+    if dtype is not None:
+        da_precip = da_precip.astype(dtype)
+        da_temp = da_temp.astype(dtype)
+    #kg/m2/s to mm/day, then mm/day to mm/month with the days in each month
+    days = da_precip.time.dt.days_in_month.astype(da_precip.dtype)
+    da_precip = ((da_precip*86400)*days).rename(da_precip.name).assign_attrs(da_precip.attrs)
+    da_precip.attrs['units'] = 'mm'
+    da_temp = (da_temp-273.15).rename(da_temp.name).assign_attrs(da_temp.attrs)
+    da_temp.attrs['units'] = 'C'
+
+    return da_precip, da_temp
+
+def openGLDAS(dataset_name, bounding_box, periodicity, netcdf, years=None, dtype=None,
+              cache_dir=None):
     """Open GLDAS datasets and return precipitation and temperature
 
     Args:
@@ -57,6 +197,13 @@ def openGLDAS(dataset_name, bounding_box, periodicity, netcdf):
         periodicity (str): The temporal resolution of the input data. Useful to
             know how the data is organized.
         netcdf (bool): Whether the input data is in netCDF format.
+        years (list): first and last years needed (None for the beginning or
+            end of the record), to only open the files of a folder that cover
+            them. Default is to open all the files.
+        dtype (str): dtype of the returned data, e.g. 'float32'. Default is the
+            dtype of the files.
+        cache_dir (str): directory of the catalog of the folder, see
+            ldasCatalog. Default is None (no catalog kept).
 
     Returns:
         da_precip (Xarra DataArray): A dataArray of precipitation
@@ -67,48 +214,23 @@ def openGLDAS(dataset_name, bounding_box, periodicity, netcdf):
             the temperature data grouped by lat/lon
     """
 
-    # Loop over all datasets in the various folders to get the data
+    # Open the files of the various folders that cover the requested years
     if netcdf == False:
         file_names = []
         if periodicity == 'monthly':
-            subdirs = [os.path.join(('./'+dataset_name),o) for o in os.listdir('./'+dataset_name)
-                        if os.path.isdir(os.path.join(('./'+dataset_name),o))]
-            for path in subdirs:
-                nc_files = (glob.glob(path+'/*.nc4'))
-                for file in nc_files:
-                    file_names.append(file)
-        file_names.sort()
-        data = xr.open_mfdataset(file_names)
+            catalog = ldasCatalog(dataset_name, 'nc4', 'lat', 'lon', cache_dir)
+            file_names = catalogFiles(dataset_name, catalog, years, bounding_box)
+        data = xr.open_mfdataset(file_names, chunks={'time': TIME_CHUNK})
     if netcdf == True:
-        data = xr.open_dataset(dataset_name)
+        data = xr.open_dataset(dataset_name, chunks={'time': TIME_CHUNK})
     p_ = data.sel(lat=slice(bounding_box[2], bounding_box[3]),\
                   lon=slice(bounding_box[0],bounding_box[1]))
-    ### PRECIPITATION
-    da_precip = p_.Rainf_f_tavg
-    ##unit transformation from kgm-2s-1 to mm
-    #days in the month
-    time = pd.to_datetime(da_precip.time.values)
-    v= time.strftime("%Y,%m")
-    days=[]
-    for item in v:
-        days.append(monthrange(int(item.split(',')[0]),int(item.split(',')[1]))[1])
-    prcp = da_precip.values
-    prcp = prcp*86400 #convert from kg/m2/s to mm/day
-    for i in np.arange(0,len(days)):
-        prcp[i,:,:] = prcp[i,:,:]*days[i]
-    da_precip.values = prcp
-    da_precip.attrs['units'] = 'mm'
-    ### TEMPERATURE
-    da_temp = p_.Tair_f_inst
-    ## Unit conversion
-    t = da_temp.values
-    t = t-273.15
-    da_temp.values = t
-    da_temp.attrs['units'] = 'C'
+    da_precip, da_temp = convertLDASUnits(p_.Rainf_f_tavg, p_.Tair_f_inst, dtype)
 
     return da_precip, da_temp
 
-def openFLDAS(dataset_name, bounding_box, periodicity, netcdf):
+def openFLDAS(dataset_name, bounding_box, periodicity, netcdf, years=None, dtype=None,
+              cache_dir=None):
     """Open FLDAS datasets and return precipitation and temperature
 
     Args:
@@ -117,6 +239,13 @@ def openFLDAS(dataset_name, bounding_box, periodicity, netcdf):
         periodicity (str): The temporal resolution of the input data. Useful to
             know how the data is organized.
         netcdf (bool): Whether the input data is in netCDF format.
+        years (list): first and last years needed (None for the beginning or
+            end of the record), to only open the files of a folder that cover
+            them. Default is to open all the files.
+        dtype (str): dtype of the returned data, e.g. 'float32'. Default is the
+            dtype of the files.
+        cache_dir (str): directory of the catalog of the folder, see
+            ldasCatalog. Default is None (no catalog kept).
 
     Returns:
         da_precip (Xarra DataArray): A dataArray of precipitation
@@ -127,53 +256,702 @@ def openFLDAS(dataset_name, bounding_box, periodicity, netcdf):
             the temperature data grouped by lat/lon
     """
 
-    # Loop over all datasets in the various folders to get the data
+    # Open the files of the various folders that cover the requested years
     if netcdf == False:
         file_names = []
         if periodicity == 'monthly':
-            subdirs = [os.path.join(('./'+dataset_name),o) for o in os.listdir('./'+dataset_name)
-                        if os.path.isdir(os.path.join(('./'+dataset_name),o))]
-            for path in subdirs:
-                nc_files = (glob.glob(path+'/*.nc'))
-                for file in nc_files:
-                    file_names.append(file)
-        file_names.sort()
-        data = xr.open_mfdataset(file_names)
+            catalog = ldasCatalog(dataset_name, 'nc', 'Y', 'X', cache_dir)
+            file_names = catalogFiles(dataset_name, catalog, years, bounding_box)
+        data = xr.open_mfdataset(file_names, chunks={'time': TIME_CHUNK})
     if netcdf == True:
-        data = xr.open_dataset(dataset_name)
+        data = xr.open_dataset(dataset_name, chunks={'time': TIME_CHUNK})
     p_ = data.sel(Y=slice(bounding_box[2], bounding_box[3]),\
                   X=slice(bounding_box[0],bounding_box[1]))
-    ### PRECIPITATION
-    da_precip = p_.Rainf_f_tavg
-    ##unit transformation from kgm-2s-1 to mm
-    #days in the month
-    time = pd.to_datetime(da_precip.time.values)
-    v= time.strftime("%Y,%m")
-    days=[]
-    for item in v:
-        days.append(monthrange(int(item.split(',')[0]),int(item.split(',')[1]))[1])
-    prcp = da_precip.values
-    prcp = prcp*86400 #convert from kg/m2/s to mm/day
-    for i in np.arange(0,len(days)):
-        prcp[i,:,:] = prcp[i,:,:]*days[i]
-    da_precip.values = prcp
-    da_precip.attrs['units'] = 'mm'
-    ### TEMPERATURE
-    da_temp = p_.Tair_f_tavg
-    ## Unit conversion
-    t = da_temp.values
-    t = t-273.15
-    da_temp.values = t
-    da_temp.attrs['units'] = 'C'
+    da_precip, da_temp = convertLDASUnits(p_.Rainf_f_tavg, p_.Tair_f_tavg, dtype)
 
     return da_precip, da_temp
+#%% Grid-wide standardized index engine
+# Same algorithm as indices.spi (monthly), run on a (time, cell) matrix at once
+# instead of one climate_indices call per grid cell.
+INDEX_MIN = -3.09
+INDEX_MAX = 3.09
+MIN_PEARSON_VALUES = 4
+GAMMA_PARAMETERS = ['gamma_alpha', 'gamma_beta', 'gamma_prob_zero']
+PEARSON_PARAMETERS = ['pearson_prob_zero', 'pearson_loc', 'pearson_scale', 'pearson_skew']
+
+def sumToScales(values, scales):
+    """Sliding sums of a (time, cell) array over several timescales
+
+    One cumulative sum along time is shared by all the timescales. The first
+    scale-1 time steps are NaN, a window containing a missing value sums to
+    NaN, and a window without any non-zero value sums to exactly zero, as in
+    compute.sum_to_scale.
+
+    Args:
+        values (numpy array): values (time x cell)
+        scales (list): number of time steps in each sum
+
+    Returns:
+        scaled (list): sliding sums (time x cell) with the dtype of values, one
+            array per timescale
+    """
+    missing = np.isnan(values)
+    #the running total is kept in double precision whatever the dtype of the values
+    start = np.zeros((1,)+values.shape[1:])
+    total = np.concatenate([start, np.cumsum(np.where(missing, 0., values), axis=0, dtype='float64')])
+    start = np.zeros((1,)+values.shape[1:], dtype='int32')
+    n_missing = np.concatenate([start, np.cumsum(missing, axis=0, dtype='int32')])
+    n_nonzero = np.concatenate([start, np.cumsum(~missing & (values != 0), axis=0, dtype='int32')])
+
+    scaled = []
+    for scale in scales:
+        sums = np.full(values.shape, np.nan, dtype=values.dtype)
+        sums[scale-1:] = np.where(n_missing[scale:] > n_missing[:-scale], np.nan,
+                                  np.where(n_nonzero[scale:] > n_nonzero[:-scale],
+                                           total[scale:]-total[:-scale], 0.))
+        scaled.append(sums)
+
+    return scaled
+
+def foldMonths(values, first_month):
+    """Fold a monthly (time, cell) array into (year, calendar month, cell)
+
+    The record is padded with NaN to start in January and end in December.
+
+    Args:
+        values (numpy array): monthly values (time x cell)
+        first_month (int): calendar month of the first time step
+
+    Returns:
+        folded (numpy array): values (year x 12 x cell)
+    """
+    before = first_month-1
+    nyears = -(-(before+values.shape[0])//12)
+    folded = np.full((nyears*12,)+values.shape[1:], np.nan, dtype=values.dtype)
+    folded[before:before+values.shape[0]] = values
+
+    return folded.reshape((nyears, 12)+values.shape[1:])
+
+def calibrationRows(first_year, nyears, calibration_start_year, calibration_end_year):
+    """Rows of a folded record within the calibration period
+
+    A calibration period that the record does not cover is replaced by the
+    full record, as in climate_indices.
+
+    Args:
+        first_year (int): year of the first row
+        nyears (int): number of rows
+        calibration_start_year (int): first year of the calibration
+        calibration_end_year (int): last year of the calibration
+
+    Returns:
+        rows (slice): calibration rows
+    """
+    last_year = first_year+nyears-1
+    if calibration_start_year < first_year or calibration_end_year > last_year+1:
+        calibration_start_year, calibration_end_year = first_year, last_year
+    calibration_end_year = min(calibration_end_year, last_year)
+
+    return slice(calibration_start_year-first_year, calibration_end_year-first_year+1)
+
+def gammaParameters(calibration):
+    """Gamma parameters of each calendar month and cell
+
+    Args:
+        calibration (numpy array): calibration values (year x 12 x cell)
+
+    Returns:
+        alphas (numpy array): shape parameters (12 x cell)
+        betas (numpy array): scale parameters (12 x cell)
+        probabilities_of_zero (numpy array): fraction of zeros among the
+            non-missing values, NaN without calibration data (12 x cell)
+    """
+    non_missing = np.sum(~np.isnan(calibration), axis=0)
+    zeros = np.sum(calibration == 0, axis=0)
+    # zeros are excluded from the fit
+    positive = np.where(calibration == 0, np.nan, calibration)
+    count = np.sum(~np.isnan(positive), axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        probabilities_of_zero = np.where(non_missing > 0, zeros/non_missing, np.nan)
+        means = np.nansum(positive, axis=0)/count
+        mean_logs = np.nansum(np.log(positive), axis=0)/count
+        a = np.log(means)-mean_logs
+        alphas = (1+np.sqrt(1+4*a/3))/(4*a)
+        betas = means/alphas
+
+    return alphas, betas, probabilities_of_zero
+
+def transformGamma(values, alphas, betas, probabilities_of_zero):
+    """Standard normal values of a gamma fit with a probability mass at zero
+
+    Args:
+        values (numpy array): values (year x 12 x cell)
+        alphas (numpy array): shape parameters (12 x cell)
+        betas (numpy array): scale parameters (12 x cell)
+        probabilities_of_zero (numpy array): probability of zero (12 x cell)
+
+    Returns:
+        fitted (numpy array): standardized values (year x 12 x cell)
+    """
+    undefined = np.isnan(probabilities_of_zero)
+    # a month that is always dry has no gamma fit: its zeros are extreme droughts
+    probabilities_of_zero = np.where((probabilities_of_zero >= 1) | undefined, 0., probabilities_of_zero)
+    zero = values == 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        probabilities = scipy.stats.gamma.cdf(np.where(zero, np.nan, values), a=alphas, scale=betas)
+    probabilities[zero] = 0.
+    probabilities = probabilities_of_zero+(1-probabilities_of_zero)*probabilities
+    fitted = scipy.stats.norm.ppf(probabilities)
+
+    return np.where((values <= 0) & undefined, np.nan, fitted)
+
+def pearsonParameters(calibration):
+    """Pearson Type III parameters of each calendar month and cell, from L-moments
+
+    Cells with fewer than four non-zero values or invalid L-moments get zero
+    parameters, as in compute.pearson_parameters.
+
+    Args:
+        calibration (numpy array): calibration values (year x 12 x cell)
+
+    Returns:
+        probabilities_of_zero, locs, scales, skews (numpy arrays): parameters (12 x cell)
+    """
+    n = np.sum(~np.isnan(calibration), axis=0)
+    zeros = np.sum(calibration == 0, axis=0)
+    # sample probability weighted moments of the sorted values (NaN sorted last)
+    ranks = np.arange(calibration.shape[0]).reshape((-1,)+(1,)*(calibration.ndim-1))
+    ordered = np.where(ranks < n, np.sort(calibration, axis=0), 0.)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        b0 = np.sum(ordered, axis=0)/n
+        b1 = np.sum(ranks*ordered, axis=0)/(n*(n-1))
+        b2 = np.sum(ranks*(ranks-1)*ordered, axis=0)/(n*(n-1)*(n-2))
+        l1 = b0
+        l2 = 2*b1-b0
+        t3 = (6*b2-6*b1+b0)/l2
+        valid = (n >= MIN_PEARSON_VALUES) & (n-zeros >= MIN_PEARSON_VALUES) & (l2 > 0) & (np.abs(t3) < 1)
+
+        # Hosking's rational approximations of the shape from the L-skewness
+        abs_t3 = np.abs(t3)
+        t = np.pi*3*abs_t3*abs_t3
+        alpha_low = (1.+0.2906*t)/(t*(1.+t*(0.1882+t*0.0442)))
+        t = 1.-abs_t3
+        alpha_high = t*(0.36067+t*(-0.59567+t*0.25361))/(1.+t*(-2.78861+t*(2.56096+t*-0.77045)))
+        alpha = np.where(abs_t3 < 0.333333333, alpha_low, alpha_high)
+        alpha_root = np.sqrt(alpha)
+        beta = np.sqrt(np.pi)*l2/scipy.special.poch(alpha, 0.5)
+        zero_skew = abs_t3 <= 1e-6
+        scales = np.where(zero_skew, l2*np.sqrt(np.pi), beta*alpha_root)
+        skews = np.where(zero_skew, 0., np.where(t3 < 0, -2./alpha_root, 2./alpha_root))
+        probabilities_of_zero = np.where(zeros > 0, zeros/n, 0.)
+
+    return (np.where(valid, probabilities_of_zero, 0.), np.where(valid, l1, 0.),
+            np.where(valid, scales, 0.), np.where(valid, skews, 0.))
+
+def transformPearson(values, probabilities_of_zero, locs, scales, skews):
+    """Standard normal values of a Pearson Type III fit
+
+    Values outside the support of the distribution and trace values are
+    pinned as in compute.transform_fitted_pearson.
+
+    Args:
+        values (numpy array): values (year x 12 x cell)
+        probabilities_of_zero, locs, scales, skews (numpy arrays): parameters (12 x cell)
+
+    Returns:
+        fitted (numpy array): standardized values (year x 12 x cell)
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        minimums = locs-((4./(skews*skews))*scales*skews)/2.
+        cdf = scipy.stats.pearson3.cdf(values, skews, locs, scales)
+    cdf = np.broadcast_to(cdf, values.shape).copy()
+    cdf[(values < 0.0005) & (probabilities_of_zero > 0)] = 0.
+    cdf[(values < 0.0005) & (probabilities_of_zero <= 0)] = 0.0005
+    cdf[(values <= minimums) & (skews >= 0)] = 0.0005
+    cdf[(values >= minimums) & (skews < 0)] = 0.9995
+    probabilities = np.clip(probabilities_of_zero+(1.-probabilities_of_zero)*cdf, 0., 1.)
+
+    return scipy.stats.norm.ppf(probabilities)
+
+def fitParameters(calibration, distribution, fallback=True):
+    """Distribution parameters of each calendar month and cell
+
+    Args:
+        calibration (numpy array): calibration values (year x 12 x cell)
+        distribution (str): 'gamma' or 'pearson'
+        fallback (bool): also fit the gamma distribution used for failed
+            Pearson Type III fits
+
+    Returns:
+        parameters (dict): parameters (12 x cell), 'gamma_alpha', 'gamma_beta'
+            and 'gamma_prob_zero' for gamma, 'pearson_prob_zero', 'pearson_loc',
+            'pearson_scale' and 'pearson_skew' for Pearson Type III
+    """
+    parameters = {}
+    if distribution == 'gamma' or fallback == True:
+        parameters.update(zip(GAMMA_PARAMETERS, gammaParameters(calibration)))
+    if distribution == 'pearson':
+        parameters.update(zip(PEARSON_PARAMETERS, pearsonParameters(calibration)))
+
+    return parameters
+
+def transformIndex(folded, parameters, distribution, fallback=True):
+    """Standardized values of a folded record from fitted parameters
+
+    Args:
+        folded (numpy array): values (year x 12 x cell)
+        parameters (dict): parameters returned by fitParameters
+        distribution (str): 'gamma' or 'pearson'
+        fallback (bool): fall back to gamma for failed Pearson Type III fits
+
+    Returns:
+        fitted (numpy array): standardized values clipped to [-3.09, 3.09] (year x 12 x cell)
+    """
+    if distribution == 'gamma':
+        fitted = transformGamma(folded, *[parameters[name] for name in GAMMA_PARAMETERS])
+    else:
+        fitted = transformPearson(folded, *[parameters[name] for name in PEARSON_PARAMETERS])
+        valid = ~np.isnan(folded)
+        lost = np.sum(valid & np.isnan(fitted), axis=(0,1))
+        failed = lost > 0.5*np.sum(valid, axis=(0,1))
+        if fallback == True and np.any(failed):
+            gamma = [parameters[name][:,failed] for name in GAMMA_PARAMETERS]
+            fitted[:,:,failed] = transformGamma(folded[:,:,failed], *gamma)
+
+    return np.clip(fitted, INDEX_MIN, INDEX_MAX)
+
+def standardizedIndex(values, scales, distribution, first_year, first_month,
+                      calibration_start_year, calibration_end_year, fallback=True,
+                      parameters=None):
+    """Standardized index of monthly values for all the cells at once
+
+    The values are summed over each timescale, fitted for each calendar month
+    and cell over the calibration period, and transformed to standard normal
+    values clipped to [-3.09, 3.09]. With fallback, a cell whose Pearson Type III
+    fit loses more than half of its valid values is fitted with a gamma
+    distribution instead, as climate_indices does for a series.
+
+    Only the valid cells are computed (see compactCells): the index of the
+    cells without data is NaN, and when all the timescales are fitted on the
+    values, the cells that are always zero share the index of one of them.
+    With parameters from a previous fit, the values may cover a few months
+    only (see appendIndex), so the cells that are zero over them are still
+    computed with their own parameters. The sums and the index have the dtype of the values
+    (see DSI_precision.py for the accuracy of float32), while the fits and
+    transforms of each timescale are done in float64.
+
+    Args:
+        values (numpy array): monthly values (time x cell), e.g. precipitation
+            for SPI or the water balance for SPEI
+        scales (list): timescales in months
+        distribution (str): 'gamma' or 'pearson'
+        first_year (int): year of the first time step
+        first_month (int): calendar month of the first time step
+        calibration_start_year (int): first year of the calibration
+        calibration_end_year (int): last year of the calibration
+        fallback (bool): fall back to gamma for failed Pearson Type III fits
+        parameters (list): parameters of each timescale from a previous fit
+            (see fitParameters), None for the timescales to fit. Default is to
+            fit all the timescales.
+
+    Returns:
+        index (numpy array): standardized index (scale x time x cell)
+        parameters (list): parameters of each timescale
+    """
+    if parameters is None:
+        parameters = [None]*len(scales)
+    cells, zero, dry = compactCells(values, all(p is None for p in parameters))
+    parameters = [None if p is None else {name: v[:,cells] for name, v in p.items()}
+                  for p in parameters]
+    full_shape = values.shape
+    values = values[:,cells]
+
+    ntime = values.shape[0]
+    index = np.empty((len(scales),)+values.shape, dtype=values.dtype)
+    for i, scaled in enumerate(sumToScales(values, scales)):
+        #fitted and transformed in double precision, one timescale at a time
+        folded = foldMonths(scaled, first_month).astype('float64', copy=False)
+        if parameters[i] is None:
+            calibration = folded[calibrationRows(first_year, folded.shape[0],
+                                                 calibration_start_year, calibration_end_year)]
+            parameters[i] = fitParameters(calibration, distribution, fallback)
+        fitted = transformIndex(folded, parameters[i], distribution, fallback)
+        index[i] = fitted.reshape((fitted.shape[0]*fitted.shape[1],)+values.shape[1:])[first_month-1:first_month-1+ntime]
+
+    return expandCells(index, full_shape[1], cells, zero, dry),\
+        [{name: expandCells(v, full_shape[1], cells, zero, dry) for name, v in p.items()}
+         for p in parameters]
+
+def compactCells(values, merge_dry=True):
+    """Cells of a (time, cell) array that need a fit
+
+    Cells without any data are skipped. Cells that are zero at every time
+    step all have the same index when they are fitted on these values, so only
+    the first of them is kept.
+
+    Args:
+        values (numpy array): values (time x cell)
+        merge_dry (bool): keep only one of the always-zero cells. Use False
+            when the cells are not fitted on the values
+
+    Returns:
+        cells (numpy array): indices of the cells to compute
+        zero (int): position in cells of the cell standing for the always-zero
+            cells, None if there are none
+        dry (numpy array): boolean mask of the always-zero cells
+    """
+    empty = np.all(np.isnan(values), axis=0)
+    dry = np.all(values == 0, axis=0) & merge_dry
+    keep = ~empty & ~dry
+    zero = None
+    if np.any(dry):
+        first_dry = int(np.argmax(dry))
+        keep[first_dry] = True
+        zero = int(np.sum(keep[:first_dry]))
+
+    return np.flatnonzero(keep), zero, dry
+
+def expandCells(compact, ncell, cells, zero, dry):
+    """Scatter an array computed on compactCells back to all the cells
+
+    Args:
+        compact (numpy array): values of the computed cells (last axis)
+        ncell (int): total number of cells
+        cells, zero, dry: output of compactCells
+
+    Returns:
+        full (numpy array): values of all the cells, NaN for the cells without data
+    """
+    full = np.full(compact.shape[:-1]+(ncell,), np.nan, dtype=compact.dtype)
+    full[...,cells] = compact
+    if zero is not None:
+        full[...,dry] = compact[...,zero,None]
+
+    return full
+
+def calibrateIndex(values, scales, distribution, first_year, first_month,
+                   calibration_start_year, calibration_end_year, fallback=True):
+    """Parameters of each timescale fitted over the calibration period, see standardizedIndex
+
+    Returns:
+        parameters (list): parameters of each timescale (see fitParameters)
+    """
+    parameters = []
+    for scaled in sumToScales(values, scales):
+        folded = foldMonths(scaled, first_month).astype('float64', copy=False)
+        calibration = folded[calibrationRows(first_year, folded.shape[0],
+                                             calibration_start_year, calibration_end_year)]
+        parameters.append(fitParameters(calibration, distribution, fallback))
+
+    return parameters
+
+def standardizedIndexArray(da, scales, distribution, calibration_start_year,
+                           calibration_end_year, fallback=True, cache=None, dtype='float64'):
+    """Standardized index of a monthly DataArray, see standardizedIndex
+
+    Args:
+        da (Xarray DataArray): monthly values with a time dimension
+        scales (list): timescales in months
+        distribution (str): 'gamma' or 'pearson'
+        calibration_start_year (int): first year of the calibration
+        calibration_end_year (int): last year of the calibration
+        fallback (bool): fall back to gamma for failed Pearson Type III fits
+        cache (dict): calibration cache, see calibrationCacheFile. The fitted
+            parameters are read from the cache when available and written to
+            it otherwise. Default is None (no cache).
+        dtype (str): 'float64' or 'float32', dtype of the computation and of
+            the index
+
+    Returns:
+        da_index (Xarray DataArray): standardized index, with a scale dimension
+            followed by the dimensions and coordinates of da (time first)
+    """
+    da = da.transpose('time', ...)
+    values = np.asarray(da.values, dtype=dtype).reshape((da.shape[0], -1))
+    start = pd.to_datetime(da.time.values[0])
+    if cache is not None:
+        filenames = [calibrationCacheFile(cache, da, distribution, scale, calibration_start_year,
+                                          calibration_end_year) for scale in scales]
+        cached = [readCalibration(filename, da) for filename in filenames]
+    else:
+        cached = None
+    index, parameters = standardizedIndex(values, scales, distribution, start.year, start.month,
+                                          calibration_start_year, calibration_end_year,
+                                          fallback, cached)
+    if cache is not None:
+        for filename, previous, fitted in zip(filenames, cached, parameters):
+            if previous is None:
+                if 'grid' in cache and cache['grid'] != gridKey(da):
+                    # a tile: its piece is merged into the file of the whole box
+                    filename = tileCacheFile(filename, da)
+                writeCalibration(filename, fitted, da)
+    da_index = xr.DataArray(index.reshape((len(scales),)+da.shape),
+                            coords=da.coords, dims=('scale',)+da.dims)
+    da_index['scale'] = ('scale', list(scales))
+    da_index['scale'].attrs['long_name'] = 'Timescale'
+    da_index['scale'].attrs['units'] = 'months'
+
+    return da_index
+
+def timescaleList(scales):
+    """List of timescales from a single timescale or a list of timescales"""
+    scale_list = [int(scale) for scale in np.atleast_1d(scales)]
+    assert len(scale_list) > 0 and all(scale >= 1 for scale in scale_list),\
+        'Valid entries for timescales field are positive numbers of months'
+
+    return scale_list
+
+def selectScales(da, scales):
+    """Drop the scale dimension when a single timescale (not a list) was requested"""
+    if np.ndim(scales) == 0:
+        return da.isel(scale=0, drop=True)
+
+    return da
+
+#%% Grid-wide Thornthwaite PET
+# Same equation as indices.pet, with the latitude of each cell broadcast
+MONTH_DAYS_NONLEAP = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+MONTH_DAYS_LEAP = np.array([31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+def monthlyDaylightHours(latitudes, leap=False):
+    """Mean daylight hours of each calendar month (FAO-56 equations 24, 25 and 34)
+
+    Args:
+        latitudes (numpy array): latitudes in degrees
+        leap (bool): whether the year is a leap year
+
+    Returns:
+        daylight (numpy array): mean daily daylight hours (12 x latitude)
+    """
+    month_days = MONTH_DAYS_LEAP if leap == True else MONTH_DAYS_NONLEAP
+    day_of_year = np.arange(1, np.sum(month_days)+1)
+    declination = 0.409*np.sin((2.0*np.pi/365.0)*day_of_year-1.39)
+    cos_sunset = -np.tan(np.radians(latitudes))[None,:]*np.tan(declination)[:,None]
+    hours = (24.0/np.pi)*np.arccos(np.clip(cos_sunset, -1.0, 1.0))
+    first_days = np.concatenate([[0], np.cumsum(month_days)[:-1]])
+
+    return np.add.reduceat(hours, first_days, axis=0)/month_days[:,None]
+
+def thornthwaite(temperature, latitudes, first_year):
+    """Monthly PET of the Thornthwaite equation for all the cells at once
+
+    Args:
+        temperature (numpy array): monthly mean temperature in C, starting in
+            January (time x cell). Negative temperatures are taken as zero.
+        latitudes (numpy array): latitude of each cell in degrees
+        first_year (int): year of the first time step
+
+    Returns:
+        pet (numpy array): PET in mm/month (time x cell)
+    """
+    ntime = temperature.shape[0]
+    values = np.maximum(foldMonths(temperature, 1), 0.)
+    #mean of the valid years, NaN for the cells without any (np.nanmean would warn)
+    valid = np.isfinite(values)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_monthly_temps = np.where(valid, values, 0.).sum(axis=0)/valid.sum(axis=0)
+        heat_index = np.sum(np.power(mean_monthly_temps/5.0, 1.514), axis=0)
+    a = (6.75e-07*heat_index**3)-(7.71e-05*heat_index**2)+(1.792e-02*heat_index)+0.49239
+
+    #daylight hours are computed once per distinct latitude
+    unique, cells = np.unique(latitudes, return_inverse=True)
+    leap = np.array([calendar.isleap(first_year+year) for year in range(values.shape[0])])
+    daylight = np.where(leap[:,None,None], monthlyDaylightHours(unique, True)[None,:,cells],
+                        monthlyDaylightHours(unique, False)[None,:,cells])
+    month_days = np.where(leap[:,None], MONTH_DAYS_LEAP, MONTH_DAYS_NONLEAP)[:,:,None]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pet = 16*(daylight/12.0)*(month_days/30.0)*((10.0*values/heat_index)**a)
+
+    return pet.reshape((-1,)+temperature.shape[1:])[:ntime]
+
+def thornthwaiteArray(da_temp, dtype='float64'):
+    """Thornthwaite PET of a monthly temperature DataArray starting in January
+
+    Args:
+        da_temp (Xarray DataArray): monthly mean temperature in C
+        dtype (str): 'float64' or 'float32', dtype of the computation and of the PET
+
+    Returns:
+        da_pet (Xarray DataArray): PET in mm/month, with the dimensions of
+            da_temp (time first)
+    """
+    da_temp = da_temp.transpose('time', ...)
+    lat_dim, lon_dim = spatialDims(da_temp)
+    latitudes = xr.broadcast(da_temp[lat_dim], da_temp.isel(time=0, drop=True))[0]
+    latitudes = latitudes.transpose(*da_temp.dims[1:]).values.reshape(-1)
+    values = np.asarray(da_temp.values, dtype=dtype).reshape((da_temp.shape[0], -1))
+    pet = thornthwaite(values, latitudes, int(da_temp.time.dt.year[0]))
+
+    return xr.DataArray(pet.reshape(da_temp.shape).astype(dtype), coords=da_temp.coords,
+                        dims=da_temp.dims)
+
+#%% Calibration cache
+# The fitted parameters only depend on the data in the calibration period (and,
+# through PET, on the whole record for SPEI), so runs that change
+# data_start_year/data_end_year can reuse the SPI parameters.
+def gridKey(da):
+    """Shape and hash of the coordinates of a grid, identifying it in the cache
+
+    Args:
+        da (Xarray DataArray or DataSet): gridded data
+
+    Returns:
+        grid (tuple): number of latitudes, number of longitudes and a hash of
+            their values
+    """
+    lat_dim, lon_dim = spatialDims(da)
+    lat = np.round(np.asarray(da[lat_dim].values, dtype='float64'), 6)
+    lon = np.round(np.asarray(da[lon_dim].values, dtype='float64'), 6)
+    digest = hashlib.sha1(lat.tobytes()+lon.tobytes()).hexdigest()[:16]
+
+    return (lat.size, lon.size, digest)
+
+def calibrationRecord(da, index, calibration_start_year, calibration_end_year):
+    """First and last month of the data a fit depends on
+
+    Args:
+        da (Xarray DataArray): the data being fitted
+        index (str): 'SPI' (the calibration period) or 'SPEI' (the whole
+            record, which sets the heat index of PET)
+        calibration_start_year (int): first year of the calibration
+        calibration_end_year (int): last year of the calibration
+
+    Returns:
+        record (tuple): first and last month, as 'YYYY-MM'
+    """
+    time = pd.to_datetime(da.time.values)
+    if index == 'SPI':
+        time = time[(time.year >= int(calibration_start_year)) & (time.year <= int(calibration_end_year))]
+    if time.size == 0:
+        return None
+
+    return (time[0].strftime('%Y-%m'), time[-1].strftime('%Y-%m'))
+
+def calibrationCacheFile(cache, da, distribution, scale, calibration_start_year,
+                         calibration_end_year, record=None):
+    """Name of the cache file holding the parameters of one fit
+
+    The file is keyed by the dataset, index, grid, record, distribution,
+    timescale and calibration period.
+
+    Args:
+        cache (dict): 'directory' of the cache, 'dataset' (a name identifying
+            the input data), 'index' ('SPI' or 'SPEI'), optionally 'dtype' of
+            the fit (default 'float64') and 'grid', the gridKey of the whole
+            bounding box when da is one of its tiles
+        da (Xarray DataArray): the data being fitted
+        distribution (str): 'gamma' or 'pearson'
+        scale (int): timescale in months
+        calibration_start_year (int): first year of the calibration
+        calibration_end_year (int): last year of the calibration
+        record (tuple): first and last month of the data the fit depends on.
+            Default is the calibrationRecord of da.
+
+    Returns:
+        filename (str): path of the cache file
+    """
+    if record is None:
+        record = calibrationRecord(da, cache['index'], calibration_start_year, calibration_end_year)
+    key = repr((cache['dataset'], cache['index'], cache.get('grid', gridKey(da)), tuple(record or ()),
+                distribution, int(scale), int(calibration_start_year), int(calibration_end_year)))
+    if cache.get('dtype', 'float64') != 'float64':
+        key += cache['dtype']
+    name = cache['index']+'_'+distribution+'_'+str(scale)+'month_'+\
+        str(calibration_start_year)+'-'+str(calibration_end_year)+'_'+\
+        hashlib.sha1(key.encode()).hexdigest()[:16]+'.nc'
+
+    return os.path.join(cache['directory'], name)
+
+def tileCacheFile(filename, da):
+    """Name of the piece of a cache file written by one tile, see mergeCalibrationTiles"""
+    return filename[:-len('.nc')]+'.tile-'+gridKey(da)[2]+'.nc'
+
+def readCalibration(filename, da):
+    """Parameters stored in a cache file
+
+    Args:
+        filename (str): path of the cache file
+        da (Xarray DataArray): the data being fitted, time first, on the grid
+            of the file or on one of its tiles
+
+    Returns:
+        parameters (dict): parameters (12 x cell), or None if the file does not
+            exist or was written for another grid
+    """
+    if os.path.isfile(filename) is False:
+        return None
+    with xr.open_dataset(filename) as ds:
+        for dim in da.dims[1:]:
+            if dim not in ds.coords or np.all(np.isin(da[dim].values, ds[dim].values)) == False:
+                print('Calibration cache '+filename+' does not match the grid, refitting')
+                return None
+        ds = ds.sel({dim: da[dim].values for dim in da.dims[1:]})
+        parameters = {name: ds[name].transpose('month', *da.dims[1:]).values.reshape((12, -1))
+                      for name in ds.data_vars}
+
+    return parameters
+
+def writeCalibration(filename, parameters, da):
+    """Write the parameters of a fit to a cache file
+
+    Args:
+        filename (str): path of the cache file
+        parameters (dict): parameters returned by fitParameters (12 x cell)
+        da (Xarray DataArray): the data that was fitted, time first
+    """
+    dims = ('month',)+da.dims[1:]
+    shape = (12,)+da.shape[1:]
+    ds = xr.Dataset({name: (dims, value.reshape(shape)) for name, value in parameters.items()},
+                    coords={dim: da[dim].values for dim in da.dims[1:] if dim in da.coords})
+    ds['month'] = ('month', np.arange(1, 13))
+    ds.attrs['title'] = 'Calibration parameters for '+os.path.basename(filename)
+    ds.attrs['date_created'] = str(date.today())
+
+    if os.path.isdir(os.path.dirname(filename) or '.') is False:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+    # write under a temporary name so tiles computed in parallel never read a partial file
+    tmp = filename+'.'+str(uuid.uuid4())+'.tmp'
+    ds.to_netcdf(tmp)
+    os.replace(tmp, filename)
+
+def mergeCalibrationTiles(cache):
+    """Merge the cache pieces written by the tiles of a bounding box
+
+    The pieces of a file are merged once they cover the whole grid, so that
+    later runs over the bounding box, tiled or not, and appendIndex find them.
+
+    Args:
+        cache (dict): calibration cache, with the 'grid' of the bounding box
+    """
+    pieces = {}
+    for piece in sorted(glob.glob(os.path.join(cache['directory'], '*.tile-*.nc'))):
+        pieces.setdefault(piece.rsplit('.tile-', 1)[0]+'.nc', []).append(piece)
+    for filename, names in pieces.items():
+        datasets = [xr.open_dataset(name) for name in names]
+        try:
+            ds = xr.combine_by_coords(datasets, combine_attrs='drop').load()
+        except ValueError:
+            ds = None
+        finally:
+            for piece in datasets:
+                piece.close()
+        if ds is None or gridKey(ds) != tuple(cache['grid']):
+            continue
+        ds.attrs['title'] = 'Calibration parameters for '+os.path.basename(filename)
+        ds.attrs['date_created'] = str(date.today())
+        tmp = filename+'.'+str(uuid.uuid4())+'.tmp'
+        ds.to_netcdf(tmp)
+        os.replace(tmp, filename)
+        for name in names:
+            os.remove(name)
+
 #%% Compute indices from xarray-like dataset
 
 ##SPI
 def SPI(da_precip, distribution = 'gamma', periodicity = 'monthly',\
         scales = 6, data_start_year = 'beginning', data_end_year = 'end',\
         calibration_start_year = 'beginning',\
-        calibration_end_year = 'end'):
+        calibration_end_year = 'end', cache = None, dtype = 'float64'):
     """Calculate SPI from precipitation
 
     This function uses the SPI calculation from the climate indices package
@@ -183,13 +961,18 @@ def SPI(da_precip, distribution = 'gamma', periodicity = 'monthly',\
         distribution (str): The distribution used to fit the data. Default is
             'gamma'. To use a Pearson Type III distribution, enter 'pearson'
         periodicity (str): Either 'monthly' or 'daily'
-        scales (int): The timescales on which the index is computed, either 6 or 12.
-            Default is 6.
+        scales (int or list): The timescale in months on which the index is computed.
+            Default is 6. With a list (e.g. [1,3,6,12,24]) all the timescales are
+            computed at once and the index has a scale dimension.
         data_start_year: Year to start computing  SPI - Default is first year in the data
         data_end_year: Year to stop computing  SPI - Default is first year in the data
         calibration_start_year: Start year for the calibration - Defauls is first year in the data
         calibration_end_year: End year for the calibration - Default is to set a 30-year  period,
             or the full dataset if shorter than 30 years
+        cache (dict): 'directory' and 'dataset' of the calibration cache (monthly
+            periodicity only), see calibrationCacheFile. Default is None (no cache)
+        dtype (str): 'float64' (default) or 'float32', dtype of the computation
+            and of the index (monthly periodicity only), see DSI_precision.py
 
     Returns:
         ds_spi (Xarray DataArray): SPI index  DataArray
@@ -197,7 +980,7 @@ def SPI(da_precip, distribution = 'gamma', periodicity = 'monthly',\
     """
 
     #Perform some checks
-    assert scales==6 or scales==12, 'Valid entries for timescales field should be 6 or 12'
+    scale_list = timescaleList(scales)
     assert distribution == 'gamma' or distribution == 'pearson', "Valid entries for distribution field should be 'gamma' or pearson'"
     assert periodicity == 'monthly' or periodicity == 'daily', "Valid entries for periodicity field should be 'monthly' or 'daily'"
 
@@ -239,27 +1022,35 @@ def SPI(da_precip, distribution = 'gamma', periodicity = 'monthly',\
         if calibration_end_year not in da_precip.time.dt.year.values:
             calibration_end_year = int(np.max(da_precip.time.dt.year))
 
-    #Groupby
-    if 'lat' in da_precip.coords:
-        da_precip_groupby = da_precip.stack(point=('lat', 'lon')).groupby('point')
-    elif 'latitude' in da_precip.coords:
-        da_precip_groupby = da_precip_groupby = da_precip.stack(point=('latitude', 'longitude')).groupby('point')
-    elif 'Y' in da_precip.coords:
-        da_precip_groupby = da_precip.stack(point=('Y', 'X')).groupby('point')
+    if periodicity == 'monthly':
+        #Perform calculation on all the grid cells at once
+        if cache is not None:
+            cache = dict(cache, index='SPI', dtype=dtype)
+        da_spi = standardizedIndexArray(da_precip.clip(min=0), scale_list, distribution,
+                                        calibration_start_year, calibration_end_year,
+                                        cache=cache, dtype=dtype)
     else:
-        raise KeyError('latitude not found')
-
-    #Perform calculation
-    da_spi = xr.apply_ufunc(indices.spi,
-                        da_precip_groupby,
-                        scales,
-                        dist,
-                        data_start_year,
-                        calibration_start_year,
-                        calibration_end_year,
-                        period)
-    #Unstack
-    da_spi = da_spi.unstack('point')
+        #Groupby
+        if 'lat' in da_precip.coords:
+            da_precip_groupby = da_precip.stack(point=('lat', 'lon')).groupby('point')
+        elif 'latitude' in da_precip.coords:
+            da_precip_groupby = da_precip_groupby = da_precip.stack(point=('latitude', 'longitude')).groupby('point')
+        elif 'Y' in da_precip.coords:
+            da_precip_groupby = da_precip.stack(point=('Y', 'X')).groupby('point')
+        else:
+            raise KeyError('latitude not found')
+
+        #Perform calculation
+        da_spi = xr.concat([xr.apply_ufunc(indices.spi,
+                                           da_precip_groupby,
+                                           scale,
+                                           dist,
+                                           data_start_year,
+                                           calibration_start_year,
+                                           calibration_end_year,
+                                           period).unstack('point')
+                            for scale in scale_list], dim=pd.Index(scale_list, name='scale'))
+    da_spi = selectScales(da_spi, scales)
     #cut
     min_idx = np.where(da_spi.time.dt.year>=data_start_year)[0][0]
     max_idx = np.where(da_spi.time.dt.year<=data_end_year)[0][-1]
@@ -279,17 +1070,17 @@ def SPI(da_precip, distribution = 'gamma', periodicity = 'monthly',\
     return ds_spi, info
 
 ## PET
-def PET(da_temp, data_start_year = 'beginning', data_end_year = 'end'):
+def PET(da_temp, data_start_year = 'beginning', data_end_year = 'end', dtype = 'float64'):
     """Calculate PET from temperature
 
-    This function uses the PET calculation from the climate indices package.
-    Monhtly only.
-    Uses Thornthwaite equation.
+    Same Thornthwaite equation as the climate indices package (indices.pet),
+    computed on all the grid cells at once. Monhtly only.
 
     Args:
         da_temp (Xarray DataArray): A dataArray of temperature
         data_start_year: Year to start computing  SPI - Default is first year in the data
         data_end_year: Year to stop computing  SPI - Default is first year in the data
+        dtype (str): 'float64' (default) or 'float32', dtype of the computation and of the PET
 
     Returns:
         ds_pet (Xarray DataSet): PET index (mm/month)
@@ -298,78 +1089,34 @@ def PET(da_temp, data_start_year = 'beginning', data_end_year = 'end'):
     """
 
     if data_start_year == 'beginning':
-        data_start_year = int(np.min(da_precip.time.dt.year))
-    elif data_start_year not in da_precip.time.dt.year.values:
+        data_start_year = int(np.min(da_temp.time.dt.year))
+    elif data_start_year not in da_temp.time.dt.year.values:
         print('Start year not in dataset, using first available year')
-        data_start_year = int(np.min(da_precip.time.dt.year))
+        data_start_year = int(np.min(da_temp.time.dt.year))
 
     if data_end_year == 'end':
-        data_end_year = int(np.max(da_precip.time.dt.year))
-    elif data_end_year not in da_precip.time.dt.year.values:
+        data_end_year = int(np.max(da_temp.time.dt.year))
+    elif data_end_year not in da_temp.time.dt.year.values:
         print('End year not in dataset, using last available year')
-        data_end_year = int(np.max(da_precip.time.dt.year))
-
-    #get latitude
-    if 'lat' in da_temp.coords:
-        lat = np.array(da_temp['lat'].values)
-    elif 'latitude' in da_temp.coords:
-        lat = np.array(da_temp['latitude'].values)
-    elif 'Y' in da_temp.coords:
-        lat = np.array(da_temp['Y'].values)
-    else:
-        raise KeyError('latitude not found')
+        data_end_year = int(np.max(da_temp.time.dt.year))
 
     #Make sure that we have full years in the data or truncate
-    if int(da_precip.time[0].dt.month) != 1:
+    start_year = int(da_temp.time.dt.year[0])
+    end_year = int(da_temp.time.dt.year[-1])
+    if int(da_temp.time.dt.month[0]) != 1:
         print("Full year not available for the beginning of the record, truncating...")
-        start_year = int(da_precip.time.dt.year[1])
-    else:
-        start_year = int(da_precip.time.dt.year[0])
-
-    if int(da_precip.time[-1].dt.month) != 12:
+        start_year += 1
+    if int(da_temp.time.dt.month[-1]) != 12:
         print("Full year not available for the end of the record, truncating...")
-        end_year = int(da_precip.time.dt.year[-2])
-    else:
-        end_year = int(da_precip.time.dt.year[-1])
-
-    #cut the data if entire years are not available.
-    min_idx = np.where(da_temp.time.dt.year>=start_year)[0][0]
-    max_idx = np.where(da_temp.time.dt.year<=end_year)[0][-1]
-    r = np.arange(min_idx,max_idx+1,1)
-    #cut along the right dimensions
-    da_temp_cut = np.take(da_temp,r,axis=da_temp.dims.index('time'))
-    da_temp_cut['time'] = da_temp_cut.time[r]
-
-    #Groupby
-    if 'lat' in da_temp.coords:
-        da_temp_groupby = da_temp.stack(point=('lat', 'lon')).groupby('point')
-    elif 'latitude' in da_precip.coords:
-        da_temp_groupby = da_temp.stack(point=('latitude', 'longitude')).groupby('point')
-    elif 'Y' in da_precip.coords:
-        da_temp_groupby = da_temp.stack(point=('Y', 'X')).groupby('point')
-    else:
-        raise KeyError('latitude not found')
+        end_year -= 1
+    years = da_temp.time.dt.year
+    da_temp_cut = da_temp.isel(time=((years>=start_year) & (years<=end_year)).values)
 
-    # perform calculation
-    da_pet = xr.apply_ufunc(indices.pet,
-                            da_temp_groupby,
-                            lat,
-                            start_year)
-    da_pet = da_pet.unstack('point')
-    #ds_pet_all = da_pet.to_dataset(name='pet')
+    # perform calculation on all the grid cells at once
+    da_pet = thornthwaiteArray(da_temp_cut, dtype)
     #cut to user define choices
-    if data_start_year>start_year:
-        min_idx = np.where(da_pet.time.dt.year>=data_start_year)[0][0]
-    else:
-        min_idx=0
-    if data_end_year<end_year:
-        max_idx = np.where(da_pet.time.dt.year<=data_end_year)[0][-1]
-    else:
-        max_idx = da_pet.time.size-1
-    r = np.arange(min_idx,max_idx+1,1)
-    #Cut along the right dimensions
-    da_pet_cut = np.take(da_pet,r,axis=da_pet.dims.index('time'))
-    da_pet_cut['time'] = da_pet_cut.time[r]
+    years = da_pet.time.dt.year
+    da_pet_cut = da_pet.isel(time=((years>=data_start_year) & (years<=data_end_year)).values)
     ds_pet=da_pet_cut.to_dataset(name='pet')
 
     info={'index':'PET'}
@@ -379,7 +1126,7 @@ def PET(da_temp, data_start_year = 'beginning', data_end_year = 'end'):
 def SPEI(da_precip, da_temp, distribution = 'gamma', periodicity = 'monthly',\
         scales = 6, data_start_year = 'beginning', data_end_year = 'end',\
         calibration_start_year = 'beginning',\
-        calibration_end_year = 'end'):
+        calibration_end_year = 'end', cache = None, dtype = 'float64', da_pet = None):
     """Calculate SPI from precipitation
 
     This function uses the SPI calculation from the climate indices package
@@ -390,13 +1137,20 @@ def SPEI(da_precip, da_temp, distribution = 'gamma', periodicity = 'monthly',\
         distribution (str): The distribution used to fit the data. Default is
             'gamma'. To use a Pearson Type III distribution, enter 'pearson'
         periodicity (str): Either 'monthly' or 'daily'
-        scales (int): The timescales on which the index is computed, either 6 or 12.
-            Default is 6.
+        scales (int or list): The timescale in months on which the index is computed.
+            Default is 6. With a list all the timescales are computed at once,
+            sharing the PET, and the index has a scale dimension.
         data_start_year: Year to start computing  SPI - Default is first year in the data
         data_end_year: Year to stop computing  SPI - Default is first year in the data
         calibration_start_year: Start year for the calibration - Defauls is first year in the data
         calibration_end_year: End year for the calibration - Default is to set a 30-year  period,
             or the full dataset if shorter than 30 years
+        cache (dict): 'directory' and 'dataset' of the calibration cache (monthly
+            periodicity only), see calibrationCacheFile. Default is None (no cache)
+        dtype (str): 'float64' (default) or 'float32', dtype of the computation
+            and of the index (monthly periodicity only), see DSI_precision.py
+        da_pet (Xarray DataArray): PET for the full length of the data, as
+            returned by PET. Computed from da_temp if None
 
     Returns:
         ds_spi (Xarray DataSet): SPEI index  DataArray
@@ -404,7 +1158,7 @@ def SPEI(da_precip, da_temp, distribution = 'gamma', periodicity = 'monthly',\
     """
 
     #Perform some checks
-    assert scales==6 or scales==12, 'Valid entries for timescales field should be 6 or 12'
+    scale_list = timescaleList(scales)
     assert distribution == 'gamma' or distribution == 'pearson', "Valid entries for distribution field should be 'gamma' or pearson'"
     assert periodicity == 'monthly' or periodicity == 'daily', "Valid entries for periodicity field should be 'monthly' or 'daily'"
 
@@ -447,47 +1201,49 @@ def SPEI(da_precip, da_temp, distribution = 'gamma', periodicity = 'monthly',\
             calibration_end_year = int(np.max(da_precip.time.dt.year))
 
     #compute pet
-    ds_pet,da_pet,info = PET(da_temp,data_start_year,\
-                             data_end_year)
+    if da_pet is None:
+        ds_pet,da_pet,info = PET(da_temp,data_start_year,\
+                                 data_end_year, dtype)
 
-    #Resize the da_precip array as needed
-    if np.min(da_precip.time.dt.year) != np.min(da_pet.time.dt.year):
-        min_idx = np.where(da_precip.time.dt.year>=np.min(da_pet.time.dt.year))[0][0]
-    else:
-        min_idx=0
-    if np.max(da_precip.time.dt.year) != np.max(da_pet.time.dt.year):
-        max_idx = np.where(da_precip.time.dt.year<=np.max(da_pet.time.dt.year))[0][0]
-    else:
-        max_idx = da_pet.time.size-1
-    r = np.arange(min_idx,max_idx+1,1)
-    da_precip_cut = np.take(da_precip,r,axis=da_precip.dims.index('time'))
-
-    #groupby
-    if 'lat' in da_temp.coords:
-        da_precip_groupby = da_precip_cut.stack(point=('lat', 'lon')).groupby('point')
-        da_pet_groupby = da_pet.stack(point=('lat', 'lon')).groupby('point')
-    elif 'latitude' in da_precip.coords:
-        da_precip_groupby = da_precip_cut.stack(point=('latitude', 'longitude')).groupby('point')
-        da_pet_groupby = da_pet.stack(point=('latitude', 'longitude')).groupby('point')
-    elif 'Y' in da_precip.coords:
-        da_precip_groupby = da_precip_cut.stack(point=('Y', 'X')).groupby('point')
-        da_pet_groupby = da_pet.stack(point=('Y', 'X')).groupby('point')
-    else:
-        raise KeyError('latitude not found')
+    #Resize the da_precip array to the full years of PET
+    da_precip_cut = da_precip.sel(time=da_pet.time)
 
-    #perform the calculation
-    da_spei=xr.apply_ufunc(indices.spei,
-                          da_precip_groupby,
-                          da_pet_groupby,
-                          scales,
-                          dist,
-                          period,
-                          data_start_year,
-                          calibration_start_year,
-                          calibration_end_year)
+    if periodicity == 'monthly':
+        #water balance, kept positive by the offset, on all the grid cells at once
+        da_balance = da_precip_cut.clip(min=0)-da_pet+1000.
+        if cache is not None:
+            cache = dict(cache, index='SPEI', dtype=dtype)
+        da_spei = standardizedIndexArray(da_balance, scale_list, distribution,
+                                         calibration_start_year, calibration_end_year,
+                                         fallback=False, cache=cache, dtype=dtype)
+    else:
+        #groupby
+        if 'lat' in da_temp.coords:
+            da_precip_groupby = da_precip_cut.stack(point=('lat', 'lon')).groupby('point')
+            da_pet_groupby = da_pet.stack(point=('lat', 'lon')).groupby('point')
+        elif 'latitude' in da_precip.coords:
+            da_precip_groupby = da_precip_cut.stack(point=('latitude', 'longitude')).groupby('point')
+            da_pet_groupby = da_pet.stack(point=('latitude', 'longitude')).groupby('point')
+        elif 'Y' in da_precip.coords:
+            da_precip_groupby = da_precip_cut.stack(point=('Y', 'X')).groupby('point')
+            da_pet_groupby = da_pet.stack(point=('Y', 'X')).groupby('point')
+        else:
+            raise KeyError('latitude not found')
+
+        #perform the calculation
+        da_spei = xr.concat([xr.apply_ufunc(indices.spei,
+                                            da_precip_groupby,
+                                            da_pet_groupby,
+                                            scale,
+                                            dist,
+                                            period,
+                                            data_start_year,
+                                            calibration_start_year,
+                                            calibration_end_year).unstack('point')
+                             for scale in scale_list], dim=pd.Index(scale_list, name='scale'))
+    da_spei = selectScales(da_spei, scales)
 
     #Cut to the right years
-    da_spei = da_spei.unstack('point')
     min_idx = np.where(da_spei.time.dt.year>=data_start_year)[0][0]
     max_idx = np.where(da_spei.time.dt.year<=data_end_year)[0][-1]
     r = np.arange(min_idx,max_idx+1,1)
@@ -502,14 +1258,258 @@ def SPEI(da_precip, da_temp, distribution = 'gamma', periodicity = 'monthly',\
             'periodicity': periodicity,
             'timescales': scales}
     return ds_spei, info
+#%% Spatially tiled execution
+def spatialDims(da):
+    """Names of the latitude and longitude dimensions of a DataArray
+
+    Args:
+        da (Xarray DataArray): gridded data
+
+    Returns:
+        lat_dim (str), lon_dim (str): names of the dimensions
+    """
+    if 'lat' in da.dims:
+        return 'lat', 'lon'
+    elif 'latitude' in da.dims:
+        return 'latitude', 'longitude'
+    elif 'Y' in da.dims:
+        return 'Y', 'X'
+    else:
+        raise KeyError('latitude not found')
+
+def computeIndices(index_names, da_precip, da_temp, args):
+    """Compute several drought indices from the same inputs
+
+    PET is computed once and shared by SPEI.
+
+    Args:
+        index_names (list): 'SPI', 'PET' and/or 'SPEI'
+        da_precip (Xarray DataArray): precipitation (None for PET only)
+        da_temp (Xarray DataArray): temperature (None for SPI only)
+        args (tuple): distribution, periodicity, scales, data_start_year,
+            data_end_year, calibration_start_year, calibration_end_year, cache, dtype
+
+    Returns:
+        results (list): the index (Xarray DataSet) and the dictionary of
+            information about the calculation of each index, in order
+    """
+    da_pet = None
+    if 'PET' in index_names or 'SPEI' in index_names:
+        ds_pet, da_pet, info_pet = PET(da_temp, args[3], args[4], args[8])
+    results = []
+    for index in index_names:
+        if index == 'SPI':
+            results.append(SPI(da_precip, *args))
+        elif index == 'PET':
+            results.append((ds_pet, dict(info_pet)))
+        elif index == 'SPEI':
+            results.append(SPEI(da_precip, da_temp, *args, da_pet=da_pet))
+
+    return results
+
+def computeIndex(index, da_precip, da_temp, args):
+    """Compute one drought index
+
+    Args:
+        index (str): 'SPI', 'PET' or 'SPEI'
+        da_precip (Xarray DataArray): precipitation (None for PET)
+        da_temp (Xarray DataArray): temperature (None for SPI)
+        args (tuple): see computeIndices
+
+    Returns:
+        ds (Xarray DataSet): the index
+        info (dict): Dictionary containing relevant information about the calculation
+    """
+    return computeIndices([index], da_precip, da_temp, args)[0]
+
+def computeIndicesTile(index_names, da_precip, da_temp, args):
+    """Compute drought indices on a tile, loading only the tile from disk"""
+    if da_precip is not None:
+        da_precip = da_precip.load()
+    if da_temp is not None:
+        da_temp = da_temp.load()
+
+    return computeIndices(index_names, da_precip, da_temp, args)
+
+def computeIndicesTiled(index_names, da_precip, da_temp, args, workers=1, tile_size=None):
+    """Compute drought indices on spatial tiles in a pool of processes
+
+    Every grid cell is independent, so the bounding box is split into tiles of
+    tile_size cells that are computed separately and stitched back together.
+    The inputs of a tile are read once for all the indices, and the
+    calibration cache is the one of the whole bounding box.
+
+    Args:
+        index_names (list): 'SPI', 'PET' and/or 'SPEI'
+        da_precip (Xarray DataArray): precipitation (None for PET only)
+        da_temp (Xarray DataArray): temperature (None for SPI only)
+        args (tuple): see computeIndices
+        workers (int): number of worker processes. Default is 1 (no pool)
+        tile_size (list): number of latitudes and longitudes in a tile. Default
+            is one band of latitudes per worker.
+
+    Returns:
+        results (list): the index over the whole bounding box (Xarray DataSet)
+            and the dictionary of information about the calculation of each
+            index, in order
+    """
+    da = da_precip if da_precip is not None else da_temp
+    if workers <= 1 and tile_size is None:
+        if len(index_names) > 1:
+            #loaded once, instead of once per index
+            return computeIndicesTile(index_names, da_precip, da_temp, args)
+        return computeIndices(index_names, da_precip, da_temp, args)
+
+    lat_dim, lon_dim = spatialDims(da)
+    nlat, nlon = da.sizes[lat_dim], da.sizes[lon_dim]
+    cache = args[7]
+    if cache is not None:
+        # the tiles share the calibration cache of the whole bounding box
+        cache = dict(cache, grid=gridKey(da))
+        args = args[:7]+(cache,)+args[8:]
+    if tile_size is None:
+        tile_size = [-(-nlat//workers), nlon]
+    tiles = [(slice(y0, y0+tile_size[0]), slice(x0, x0+tile_size[1]))
+             for y0 in range(0, nlat, tile_size[0]) for x0 in range(0, nlon, tile_size[1])]
+
+    def cut(da, tile):
+        return None if da is None else da.isel({lat_dim: tile[0], lon_dim: tile[1]})
+    n = len(tiles)
+    tile_args = ([index_names]*n, [cut(da_precip, t) for t in tiles], [cut(da_temp, t) for t in tiles], [args]*n)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, n)) as executor:
+            results = list(executor.map(computeIndicesTile, *tile_args))
+    else:
+        results = list(map(computeIndicesTile, *tile_args))
+    if cache is not None:
+        mergeCalibrationTiles(cache)
+
+    # rows of tiles along the latitude, each row along the longitude
+    ncol = -(-nlon//tile_size[1])
+    stitched = []
+    for i in range(len(index_names)):
+        nested = [[result[i][0] for result in results[row:row+ncol]] for row in range(0, n, ncol)]
+        stitched.append((xr.combine_nested(nested, concat_dim=[lat_dim, lon_dim]), results[0][i][1]))
+
+    return stitched
+
+def computeIndexTiled(index, da_precip, da_temp, args, workers=1, tile_size=None):
+    """Compute a drought index on spatial tiles in a pool of processes
+
+    Args:
+        index (str): 'SPI', 'PET' or 'SPEI'
+        da_precip (Xarray DataArray): precipitation (None for PET)
+        da_temp (Xarray DataArray): temperature (None for SPI)
+        args (tuple): see computeIndices
+        workers (int): number of worker processes. Default is 1 (no pool)
+        tile_size (list): number of latitudes and longitudes in a tile, see
+            computeIndicesTiled
+
+    Returns:
+        ds (Xarray DataSet): the index over the whole bounding box
+        info (dict): Dictionary containing relevant information about the calculation
+    """
+    return computeIndicesTiled([index], da_precip, da_temp, args, workers, tile_size)[0]
+
 #%% Return a netcdf using MINT conventions
-def to_netcdfMint(ds, info, dataset_type, bounding_box, dir_out):
+def timescaleText(scales):
+    """Description of the timescales, e.g. 'a 6-month timescale'"""
+    if np.ndim(scales) == 0:
+        return 'a '+str(scales)+'-month timescale'
+
+    return ', '.join(str(scale) for scale in scales)+'-month timescales'
+
+def calibrationAttributes(ds, info):
+    """Store the settings of the calculation, read back by appendMint"""
+    ds.attrs['distribution'] = info['distribution']
+    ds.attrs['timescales'] = np.atleast_1d(info['timescales']).astype('int32')
+    ds.attrs['calibration_start_year'] = np.int32(info['calibration_start'])
+    ds.attrs['calibration_end_year'] = np.int32(info['calibration_end'])
+
+# largest spatial tile of a chunk in the output files
+SPATIAL_CHUNK = 128
+
+def valueRange(values, block=2**20):
+    """Minimum and maximum of an array, ignoring NaN
+
+    Both are taken block by block, so the array is read from memory once
+    instead of once per statistic.
+
+    Args:
+        values (numpy array): the index
+        block (int): number of values reduced at a time
+
+    Returns:
+        vmin (float): minimum, NaN if there are only missing values
+        vmax (float): maximum, NaN if there are only missing values
+    """
+    flat = np.ravel(values)
+    vmin, vmax = np.nan, np.nan
+    with np.errstate(invalid='ignore'):
+        for start in range(0, np.size(flat), block):
+            part = flat[start:start+block]
+            vmin = np.fmin(vmin, np.fmin.reduce(part))
+            vmax = np.fmax(vmax, np.fmax.reduce(part))
+
+    return vmin, vmax
+
+def indexEncoding(da, complevel=1, chunks=None, dtype=None):
+    """Netcdf encoding of an index variable
+
+    The values are compressed with zlib/shuffle, missing values are stored as
+    NaN. Chunks span TIME_CHUNK months over spatial tiles of up to
+    SPATIAL_CHUNK cells and a single timescale, so a map or the time series of a
+    region touch few chunks. The tiles split the grid evenly, since the edge
+    chunks are padded to the full chunk size in the file.
+
+    Args:
+        da (xarray DataArray): the index
+        complevel (int): zlib compression level. With 0, the index is written
+            uncompressed and unchunked, unless chunks are given
+        chunks (list): time, lat and lon chunk sizes. Default: TIME_CHUNK
+            and SPATIAL_CHUNK
+        dtype (str): dtype of the variable in the file. Default: dtype of da
+
+    Returns:
+        encoding (dict): xarray encoding of the variable
+    """
+    encoding = {'dtype': str(da.dtype) if dtype is None else dtype,
+                '_FillValue': np.nan}
+    if complevel > 0:
+        encoding.update({'zlib': True, 'shuffle': True, 'complevel': complevel})
+    elif chunks is None:
+        return encoding
+
+    if chunks is None:
+        chunks = (TIME_CHUNK, SPATIAL_CHUNK, SPATIAL_CHUNK)
+    time_size, lat_size, lon_size = chunks
+    lat_dim, lon_dim = spatialDims(da)
+    chunksizes = []
+    for dim, size in zip(da.dims, da.shape):
+        if dim == 'scale':
+            chunksizes.append(1)
+        elif dim == 'time':
+            chunksizes.append(max(1, min(size, time_size)))
+        else:
+            limit = lat_size if dim == lat_dim else lon_size
+            ntile = int(np.ceil(size/max(1, limit)))
+            chunksizes.append(max(1, int(np.ceil(size/max(1, ntile)))))
+    encoding['chunksizes'] = tuple(chunksizes)
+
+    return encoding
+
+def to_netcdfMint(ds, info, dataset_type, bounding_box, dir_out, complevel=1, chunks=None, dtype=None):
     """Returns a MINT-ready netcdf file with SPI values
 
     Args:
         ds (Xarray DataSet): A dataset of drought indices
         info (dict): Dictionary containing pertinent information frpm calculation
         dir_out (str): The out directory to write the netcdf files
+        complevel (int): zlib compression level of the index, 0 to write
+            uncompressed (see indexEncoding)
+        chunks (list): time, lat and lon chunk sizes of the index
+        dtype (str): dtype of the index in the file, e.g. 'float32'.
+            Default: dtype of the calculation
 
     Returns:
         NetCDF ouput in MINT Format
@@ -527,8 +1527,9 @@ def to_netcdfMint(ds, info, dataset_type, bounding_box, dir_out):
         ds.attrs['summary'] = info['periodicity']+' standardized precipitation index inferred from '\
         + dataset_type +', using a calibration period from '+\
         str(info['calibration_start']) + ' to '+ str(info['calibration_end'])+\
-            ' using a '+ info['distribution']+ ' distribution with a '+\
-            str(info['timescales'])+ '-month timescale.'
+            ' using a '+ info['distribution']+ ' distribution with '+\
+            timescaleText(info['timescales'])+'.'
+        calibrationAttributes(ds, info)
     elif info['index']== 'PET':
         long_name = 'Potential Evapotranspiration'
         ds.attrs['title'] = long_name
@@ -541,8 +1542,9 @@ def to_netcdfMint(ds, info, dataset_type, bounding_box, dir_out):
         ds.attrs['summary'] = info['periodicity']+' standardized precipitation  evapotranspiration index inferred from '\
         + dataset_type +', using a calibration period from '+\
         str(info['calibration_start']) + ' to '+ str(info['calibration_end'])+\
-            ' using a '+ info['distribution']+ ' distribution with a '+\
-            str(info['timescales'])+ '-month timescale.'
+            ' using a '+ info['distribution']+ ' distribution with '+\
+            timescaleText(info['timescales'])+'.'
+        calibrationAttributes(ds, info)
     ds.attrs['naming_authority'] = "MINT Workflow"
     ds.attrs['id'] = str(uuid.uuid4())
     ds.attrs['date_created'] = str(date.today())
@@ -565,27 +1567,30 @@ def to_netcdfMint(ds, info, dataset_type, bounding_box, dir_out):
        ds.spi.attrs['standard_name'] = 'atmosphere_water__standardized_precipitation_wetness_index'
        ds.spi.attrs['long_name'] = 'Standardized Precipitation Index'
        ds.spi.attrs['units'] = 'unitless'
-       ds.spi.attrs['valid_min'] = np.min(ds.spi.values)
-       ds.spi.attrs['valid_max'] = np.max(ds.spi.values)
-       ds.spi.attrs['valid_range'] = list((np.min(ds.spi.values), np.max(ds.spi.values)))
+       vmin, vmax = valueRange(ds.spi.values)
+       ds.spi.attrs['valid_min'] = vmin
+       ds.spi.attrs['valid_max'] = vmax
+       ds.spi.attrs['valid_range'] = [vmin, vmax]
        ds.spi.attrs['missing_value'] = np.nan
     elif info['index'] == 'PET':
        ds.pet.attrs['title'] = 'Potential Evapotranspiration'
        ds.pet.attrs['standard_name'] = 'atmosphere_soil_water__thornthwaite_potential_evapotranspiration_volume'
        ds.pet.attrs['long_name'] = 'Potential Evapotranspiration'
        ds.pet.attrs['units'] = 'mm/month'
-       ds.pet.attrs['valid_min'] = np.min(ds.pet.values)
-       ds.pet.attrs['valid_max'] = np.max(ds.pet.values)
-       ds.pet.attrs['valid_range'] = list((np.min(ds.pet.values), np.max(ds.pet.values)))
+       vmin, vmax = valueRange(ds.pet.values)
+       ds.pet.attrs['valid_min'] = vmin
+       ds.pet.attrs['valid_max'] = vmax
+       ds.pet.attrs['valid_range'] = [vmin, vmax]
        ds.pet.attrs['missing_value'] = np.nan
     elif info['index'] == 'SPEI':
        ds.spei.attrs['title'] = 'Standardized Precipitation Evapotranspiration Index'
        ds.spei.attrs['standard_name'] = 'land_region_water__standardized_precipitation_evapotranspiration_drought_intensity_index'
        ds.spei.attrs['long_name'] = 'Standardized Precipitation Index'
        ds.spei.attrs['units'] = 'unitless'
-       ds.spei.attrs['valid_min'] = np.min(ds.spei.values)
-       ds.spei.attrs['valid_max'] = np.max(ds.spei.values)
-       ds.spei.attrs['valid_range'] = list((np.min(ds.spei.values), np.max(ds.spei.values)))
+       vmin, vmax = valueRange(ds.spei.values)
+       ds.spei.attrs['valid_min'] = vmin
+       ds.spei.attrs['valid_max'] = vmax
+       ds.spei.attrs['valid_range'] = [vmin, vmax]
        ds.spei.attrs['missing_value'] = np.nan
 
     #Write it out to file
@@ -601,32 +1606,137 @@ def to_netcdfMint(ds, info, dataset_type, bounding_box, dir_out):
                 '_'+\
                 ds.attrs['time_coverage_end'].split('T')[0]+\
                 '_'+ds.attrs['id']+'.nc'
-    ds.to_netcdf(path = path)
+    #unlimited time so that appendMint can add new months in place
+    varname = info['index'].lower()
+    encoding = {varname: indexEncoding(ds[varname], complevel, chunks, dtype)}
+    ds.to_netcdf(path = path, unlimited_dims=['time'], encoding=encoding)
+
+INDEX_LEVELS = np.arange(-4,4.2,0.2)
+
+def indexFigure(lat, lon, label):
+    """Draw the map, colorbar and gridlines shared by all the months
+
+    Args:
+        lat (numpy array): latitude vector
+        lon (numpy array): longitude vector
+        label (str): title of the colorbar
+
+    Returns:
+        frame (dict): figure, axes, title, overlay and background of the map
+    """
+    proj = ccrs.PlateCarree()
+    fig,ax = plt.subplots(figsize=[15,10])
+    ax = plt.axes(projection=proj)
+    ax.add_feature(cfeature.BORDERS)
+    ax.add_feature(cfeature.COASTLINE)
+    ax.add_feature(cfeature.RIVERS)
+    # an empty map sets the extent and the colorbar
+    img = plt.contourf(lon, lat, np.zeros((np.size(lat),np.size(lon))), levels=INDEX_LEVELS,
+        cmap=cm.BrBG,
+        transform=proj,
+        vmin = -4,
+        vmax =4)
+    tick_range = np.arange(-4,4.5,0.5)
+    cbar = plt.colorbar(img, orientation='horizontal',pad=0.1, ticks=tick_range)
+    cbar.ax.set_title(label)
+    gl = ax.gridlines(crs=ccrs.PlateCarree(), draw_labels=True,
+                  linewidth=2, color='gray', alpha=0.5, linestyle='--')
+    gl.xlabels_top = False
+    gl.ylabels_right = False
+    gl.xlines = False
+    gl.ylines = False
+    gl.xlocator = mticker.FixedLocator(np.linspace(np.round(np.min(lon)),np.round(np.max(lon)),5))
+    gl.ylocator = mticker.FixedLocator(np.linspace(np.round(np.min(lat)),np.round(np.max(lat)),5))
+    gl.xformatter = LONGITUDE_FORMATTER
+    gl.yformatter = LATITUDE_FORMATTER
+    gl.xlabel_style = {'size': 12, 'color': 'gray'}
+    gl.ylabel_style = {'size': 12, 'color': 'gray'}
+    # placeholder so that the title is positioned like a dated one
+    title = plt.title(' ', fontsize=18, loc='left', pad=1)
+    zorder = contourArtists(img)[0].get_zorder()
+    for c in contourArtists(img):
+        c.remove()
+    overlay = sorted([a for a in ax.get_children() if a.get_zorder()>zorder],
+                     key=lambda a: a.get_zorder())
+    for a in overlay:
+        a.set_animated(True)
+    fig.canvas.draw()
+
+    frame = {'fig': fig,
+             'ax': ax,
+             'proj': proj,
+             'title': title,
+             'overlay': overlay,
+             'background': fig.canvas.copy_from_bbox(fig.bbox)}
+
+    return frame
+
+def contourArtists(img):
+    """Artists drawn by contourf"""
+    if isinstance(img, matplotlib.artist.Artist):
+        return [img]
+    return img.collections
+
+def drawIndexFrame(frame, v, date, lat, lon):
+    """Draw the index of one month over the static map
+
+    Args:
+        frame (dict): map created by indexFigure
+        v (numpy array): the index for the month (lat x lon)
+        date (str): date used as the title
+        lat (numpy array): latitude vector
+        lon (numpy array): longitude vector
 
-def visualizeDroughtIndex(ds, dir_out, info, dataset_type):
+    Returns:
+        rgb (numpy array): the rendered frame (height x width x 3)
+    """
+    fig = frame['fig']
+    ax = frame['ax']
+    fig.canvas.restore_region(frame['background'])
+    artists = []
+    if np.isnan(v).all()==False:
+        img = ax.contourf(lon, lat, v, levels=INDEX_LEVELS,
+            cmap=cm.BrBG,
+            transform=frame['proj'],
+            vmin = -4,
+            vmax =4)
+        artists = contourArtists(img)
+    frame['title'].set_text(date)
+    for a in artists+frame['overlay']:
+        ax.draw_artist(a)
+    rgb = np.array(fig.canvas.buffer_rgba())[:,:,:3]
+    for c in artists:
+        c.remove()
+
+    return rgb
+
+def visualizeDroughtIndex(ds, dir_out, info, dataset_type, save_frames=False):
     """ Visualization of drought index
 
     Args:
         ds (xarray dataset): the dataset containing the index
         dir_out (str): the output directory for the visualization
+        save_frames (bool): also save each frame as a png in figures/
     """
-    proj = ccrs.PlateCarree()
+    #One movie per timescale
+    if 'scale' in ds.dims:
+        for scale in ds['scale'].values:
+            ds_scale = ds.sel(scale=scale, drop=True)
+            ds_scale.attrs['id'] = ds.attrs['id']+'_'+str(scale)+'month'
+            info_scale = dict(info, timescales=int(scale))
+            visualizeDroughtIndex(ds_scale, dir_out, info_scale, dataset_type, save_frames)
+        return
+
     idx = np.size(ds['time'])
-    count = list(np.arange(0,idx,1))
     varname = list(ds.data_vars.keys())[0]
-    filenames =[]
+    if dir_out[-1]!='/':
+        dir_out = dir_out+'/'
 
     #Make a directory for results/figures if it doesn't exit
-    if dir_out[-1]=='/':
-        if os.path.isdir(dir_out+'figures') is False:
-            os.makedirs(dir_out+'figures')
-        if os.path.isdir(dir_out+'results') is False:
-            os.makedirs(dir_out+'results')
-    else:
-        if os.path.isdir(dir_out+'/figures') is False:
-            os.makedirs(dir_out+'/figures')
-        if os.path.isdir(dir_out+'/results') is False:
-            os.makedirs(dir_out+'/results')
+    if save_frames == True and os.path.isdir(dir_out+'figures') is False:
+        os.makedirs(dir_out+'figures')
+    if os.path.isdir(dir_out+'results') is False:
+        os.makedirs(dir_out+'results')
 
     if 'lat' in ds:
         lat = ds.lat.values
@@ -640,97 +1750,261 @@ def visualizeDroughtIndex(ds, dir_out, info, dataset_type):
     else:
         raise KeyError('latitude not found')
 
-    for i in count:
-        v = ds[varname].values[i,:,:]
-        date = pd.to_datetime(ds.time.values[i]).strftime("%B %Y")
-        fig,ax = plt.subplots(figsize=[15,10])
-        ax = plt.axes(projection=proj)
-        ax.add_feature(cfeature.BORDERS)
-        ax.add_feature(cfeature.COASTLINE)
-        ax.add_feature(cfeature.RIVERS)
-        levels = np.arange(-4,4.2,0.2)
-        if np.isnan(v).all()==False:
-            img = plt.contourf(lon, lat, v, levels=levels,
-                cmap=cm.BrBG,
-                transform=proj,
-                vmin = -4,
-                vmax =4)
-            tick_range = np.arange(-4,4.5,0.5)
-            cbar = plt.colorbar(img, orientation='horizontal',pad=0.1, ticks=tick_range)
-            string = ', inferred from' + dataset_type +\
-                    ' over a calibration period from '+ str(info['calibration_start']) +\
-                    ' to '+ str(info['calibration_end']) + ', using a '+info['distribution']+\
-                    ' distribution and '+str(info['timescales'])+'-month timescale.'
-            if varname == 'spi':
-                cbar.ax.set_title('Standardized Precipitation Index'+string)
-            elif varname == 'pet':
-                cbar.ax.set_title('Potential Evapotranspiration (mm/month)'+string)
-            elif varname == 'spei':
-                cbar.ax.set_title('Standardized Precipitation-Evapotranspiration Index'+string)
-            else:
-                cbar.ax.set_title(varname)
-        gl = ax.gridlines(crs=ccrs.PlateCarree(), draw_labels=True,
-                      linewidth=2, color='gray', alpha=0.5, linestyle='--')
-        gl.xlabels_top = False
-        gl.ylabels_right = False
-        gl.xlines = False
-        gl.ylines = False
-        gl.xlocator = mticker.FixedLocator(np.linspace(np.round(np.min(lon)),np.round(np.max(lon)),5))
-        gl.ylocator = mticker.FixedLocator(np.linspace(np.round(np.min(lat)),np.round(np.max(lat)),5))
-        gl.xformatter = LONGITUDE_FORMATTER
-        gl.yformatter = LATITUDE_FORMATTER
-        gl.xlabel_style = {'size': 12, 'color': 'gray'}
-        gl.ylabel_style = {'size': 12, 'color': 'gray'}
-        #Add a title with time
-        plt.title(date, fontsize=18, loc='left', pad=1)
-        #save a jepg
-        if dir_out[-1]=='/':
-            filename = dir_out+'figures/'+varname+'_t'+str(date)+'.png'
-        else:
-            filename = dir_out+'/figures/'+varname+'_t'+str(date)+'.png'
-        filenames.append(filename)
-        plt.savefig(filename)
-        plt.close(fig)
-
-    #create a gif
-    if dir_out[-1]=='/':
-        writer = imageio.get_writer(dir_out+'results/'+varname+'_'+ds.attrs['id']+'.mp4', fps=5)
+    string = ', inferred from' + dataset_type +\
+            ' over a calibration period from '+ str(info['calibration_start']) +\
+            ' to '+ str(info['calibration_end']) + ', using a '+info['distribution']+\
+            ' distribution and '+str(info['timescales'])+'-month timescale.'
+    if varname == 'spi':
+        label = 'Standardized Precipitation Index'+string
+    elif varname == 'pet':
+        label = 'Potential Evapotranspiration (mm/month)'+string
+    elif varname == 'spei':
+        label = 'Standardized Precipitation-Evapotranspiration Index'+string
     else:
-        writer = imageio.get_writer(dir_out+'/results/'+varname+'_'+ds.attrs['id']+'.mp4', fps=5)
+        label = varname
+    frame = indexFigure(lat, lon, label)
 
-    for filename in filenames:
-        writer.append_data(imageio.imread(filename))
+    #create the movie
+    values = ds[varname].values
+    writer = imageio.get_writer(dir_out+'results/'+varname+'_'+ds.attrs['id']+'.mp4', fps=5)
+    for i in range(idx):
+        date = pd.to_datetime(ds.time.values[i]).strftime("%B %Y")
+        rgb = drawIndexFrame(frame, values[i,:,:], date, lat, lon)
+        writer.append_data(rgb)
+        if save_frames == True:
+            imageio.imwrite(dir_out+'figures/'+varname+'_t'+str(date)+'.png', rgb)
     writer.close()
+    plt.close(frame['fig'])
+
+
+
+#%% Append new months to a MINT file
+def newMonths(filename, da):
+    """Time steps of the input that come after the end of a MINT file
+
+    Args:
+        filename (str): file written by to_netcdfMint
+        da (Xarray DataArray): monthly input data
+
+    Returns:
+        new_time (numpy array): time steps of da after the last time of the file
+    """
+    with xr.open_dataset(filename) as ds:
+        last = ds.time.values[-1]
+    new_time = da.time.values[da.time.values > last]
+    if np.size(new_time) > 0:
+        expected = pd.to_datetime(last).to_period('M')+1
+        if pd.to_datetime(new_time[0]).to_period('M') != expected:
+            raise ValueError('The input starts after '+str(expected)+', the month following '+filename)
+
+    return new_time
+
+def appendIndex(filename, da_precip, cache=None, dtype='float64'):
+    """Compute the SPI of new months and add them at the end of a MINT file
+
+    Only the new months are transformed. They are summed with the trailing
+    months of the input (the longest timescale minus one) and standardized
+    with the calibration parameters of the original run, read from the cache.
+    If the cache is not available, the parameters are fitted again on the
+    input, which must then cover the calibration period.
+
+    Args:
+        filename (str): SPI file written by to_netcdfMint
+        da_precip (Xarray DataArray): monthly precipitation covering the new
+            months and the trailing accumulation window
+        cache (dict): 'directory' and 'dataset' of the calibration cache, see
+            calibrationCacheFile. Default is None (refit).
+        dtype (str): 'float64' (default) or 'float32', dtype of the computation,
+            as in the original run (its cache entries are kept per dtype)
 
+    Returns:
+        new_time (numpy array): time steps added to the file
+    """
+    with xr.open_dataset(filename) as ds:
+        if 'spi' not in ds.data_vars:
+            raise ValueError('Append mode is only available for SPI: PET (and SPEI) are computed over full years of the record')
+        if 'timescales' not in ds.attrs:
+            raise ValueError(filename+' does not record its calibration, rerun the full calculation')
+        distribution = ds.attrs['distribution']
+        scales = [int(scale) for scale in np.atleast_1d(ds.attrs['timescales'])]
+        calibration_start_year = int(ds.attrs['calibration_start_year'])
+        calibration_end_year = int(ds.attrs['calibration_end_year'])
+        has_scale = 'scale' in ds.spi.dims
+
+    new_time = newMonths(filename, da_precip)
+    if np.size(new_time) == 0:
+        print('No new months to append to '+filename)
+        return new_time
+
+    #trailing months needed by the longest accumulation
+    da = da_precip.clip(min=0).transpose('time', ...)
+    first = int(np.searchsorted(da.time.values, new_time[0]))
+    if first < max(scales)-1:
+        raise ValueError('The input should include the '+str(max(scales)-1)+' months before the new ones')
+    da_window = da.isel(time=slice(first-max(scales)+1, None))
+
+    #calibration parameters, from the cache when possible
+    parameters = [None]*len(scales)
+    years = da.time.dt.year.values
+    covered = calibration_start_year >= years[0] and calibration_end_year <= years[-1]
+    if cache is not None:
+        cache = dict(cache, index='SPI', dtype=dtype)
+        # without the calibration period, assume the original run covered it
+        record = None if covered else (str(calibration_start_year)+'-01', str(calibration_end_year)+'-12')
+        filenames = [calibrationCacheFile(cache, da, distribution, scale, calibration_start_year,
+                                          calibration_end_year, record) for scale in scales]
+        parameters = [readCalibration(f, da) for f in filenames]
+    if any(p is None for p in parameters):
+        if covered is False:
+            raise ValueError('No cached calibration and the input does not cover the calibration period')
+        print('Calibration parameters not cached, fitting them on the input')
+        start = pd.to_datetime(da.time.values[0])
+        values = np.asarray(da.values, dtype=dtype).reshape((da.shape[0], -1))
+        fitted = calibrateIndex(values, scales, distribution, start.year, start.month,
+                                calibration_start_year, calibration_end_year)
+        parameters = [p if p is not None else f for p, f in zip(parameters, fitted)]
+        if cache is not None:
+            for f, p in zip(filenames, parameters):
+                writeCalibration(f, p, da)
+
+    start = pd.to_datetime(da_window.time.values[0])
+    values = np.asarray(da_window.values, dtype=dtype).reshape((da_window.shape[0], -1))
+    index, parameters = standardizedIndex(values, scales, distribution, start.year, start.month,
+                                          calibration_start_year, calibration_end_year,
+                                          parameters=parameters)
+    index = index[:, -np.size(new_time):].reshape((len(scales), np.size(new_time))+da.shape[1:])
+    if has_scale is False:
+        index = index[0]
+    appendMint(filename, 'spi', index, new_time)
+
+    return new_time
+
+def appendMint(filename, varname, values, time):
+    """Write new time steps at the end of a MINT file and update its attributes
 
+    Args:
+        filename (str): file written by to_netcdfMint
+        varname (str): name of the index variable
+        values (numpy array): the index for the new time steps, with the
+            dimensions of the variable in the file
+        time (numpy array): Vector of time for the new time steps
+    """
+    nc = netCDF4.Dataset(filename, 'a')
+    if nc.dimensions['time'].isunlimited() is False:
+        nc.close()
+        #files written before the time dimension was unlimited are rewritten
+        with xr.open_dataset(filename) as ds:
+            ds = ds.load()
+        dims = ds[varname].dims
+        da_new = xr.DataArray(values, dims=dims, coords={**{d: ds[d] for d in dims if d != 'time'},
+                                                        'time': time})
+        ds_new = xr.concat([ds, da_new.to_dataset(name=varname)], dim='time', combine_attrs='override')
+        ds_new.to_netcdf(filename+'.tmp', unlimited_dims=['time'])
+        os.replace(filename+'.tmp', filename)
+        nc = netCDF4.Dataset(filename, 'a')
+    else:
+        nc_time = nc['time']
+        start = len(nc_time)
+        nc_time[start:start+np.size(time)] = netCDF4.date2num(pd.to_datetime(time).to_pydatetime(),
+                                                              nc_time.units,
+                                                              getattr(nc_time, 'calendar', 'standard'))
+        axis = nc[varname].dimensions.index('time')
+        region = tuple(slice(start, start+np.size(time)) if i == axis else slice(None)
+                       for i in range(values.ndim))
+        nc[varname][region] = np.ma.masked_invalid(values)
+
+    nc_var = nc[varname]
+    vmin, vmax = valueRange(values)
+    nc_var.valid_min = np.fmin(nc_var.valid_min, vmin)
+    nc_var.valid_max = np.fmax(nc_var.valid_max, vmax)
+    nc_var.valid_range = [nc_var.valid_min, nc_var.valid_max]
+    nc.time_coverage_end = str(time[-1])
+    nc.date_modified = str(date.today())
+    nc.close()
 
 #%% Main
-if __name__ == "__main__":
-    dataset_type = sys.argv[1]
-    index = sys.argv[4]
-    dataset_name = sys.argv[2] #file name or directory name
-    bounding_box = ast.literal_eval(sys.argv[5])
-    distribution = sys.argv[6].lower()
-    periodicity = sys.argv[7].lower()
-    scales = int(sys.argv[8])
-    try:
-        data_start_year= int(sys.argv[9])
-    except:
-        data_start_year = sys.argv[9]
-    try:
-        data_end_year = int(sys.argv[10])
-    except:
-        data_end_year = sys.argv[10]
+def parseYear(text):
+    """Year given on the command line: an integer, or 'beginning'/'end'"""
     try:
-        calibration_start_year = int(sys.argv[11])
-    except:
-        calibration_start_year = sys.argv[11]
-    try:
-        calibration_end_year = int(sys.argv[12])
-    except:
-        calibration_end_year = sys.argv[12]
-    dir_out = sys.argv[3]
-    fig = ast.literal_eval(sys.argv[13])
+        return int(text)
+    except ValueError:
+        return text
+
+def requiredYears(index, scales, data_start_year, data_end_year,
+                  calibration_start_year, calibration_end_year):
+    """First and last years of input needed by a calculation
+
+    SPI needs the data and calibration years, plus the months before them that
+    enter the longest accumulation. PET (and SPEI) use the temperature
+    climatology of the whole record, so all years are needed.
+
+    Returns:
+        years (list): first and last years, None for the beginning or end of
+            the record
+    """
+    if index != 'SPI':
+        return None
+    first, last = None, None
+    if data_start_year != 'beginning' and calibration_start_year != 'beginning':
+        lead = int(np.ceil((max(np.atleast_1d(scales))-1)/12))
+        first = min(data_start_year, calibration_start_year)-lead
+    if data_end_year != 'end' and calibration_end_year != 'end':
+        last = max(data_end_year, calibration_end_year)
+
+    return [first, last]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dataset_type", type=str, help="CHIRPS, GLDAS or FLDAS")
+    parser.add_argument("dataset_name", type=str, help="file name or directory name")
+    parser.add_argument("dir_out", type=str, help="output directory")
+    parser.add_argument("index", type=lambda text: text.split(','),
+                        help="SPI, PET or SPEI, or several separated by commas e.g. SPI,PET,SPEI,"+
+                        " computed from one load of the inputs")
+    parser.add_argument("bounding_box", type=ast.literal_eval, help="[min_lon,max_lon,min_lat,max_lat]")
+    parser.add_argument("distribution", type=str.lower, help="gamma or pearson")
+    parser.add_argument("periodicity", type=str.lower, help="monthly")
+    parser.add_argument("scales", type=ast.literal_eval,
+                        help="timescale in months, or a list of timescales e.g. [1,3,6,12,24]")
+    parser.add_argument("data_start_year", type=parseYear, help="first year of the output, or 'beginning'")
+    parser.add_argument("data_end_year", type=parseYear, help="last year of the output, or 'end'")
+    parser.add_argument("calibration_start_year", type=parseYear, help="first year of the calibration, or 'beginning'")
+    parser.add_argument("calibration_end_year", type=parseYear, help="last year of the calibration, or 'end'")
+    parser.add_argument("fig", type=ast.literal_eval, help="True to make the movie")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of spatial tiles computed in parallel")
+    parser.add_argument("--tile", type=int, nargs=2, default=None, metavar=("NLAT","NLON"),
+                        help="spatial tile size, to bound the memory used by each worker")
+    parser.add_argument("--cache", type=str, default=None,
+                        help="directory of the calibration parameter cache (monthly SPI/SPEI)"+\
+                        " and of the catalog of LDAS folders")
+    parser.add_argument("--float32", action="store_true",
+                        help="load, compute and write the index in single precision (see DSI_precision.py)")
+    parser.add_argument("--complevel", type=int, default=1, choices=range(10),
+                        help="zlib compression level of the output, 0 to write it uncompressed")
+    parser.add_argument("--chunks", type=int, nargs=3, default=None, metavar=("NTIME","NLAT","NLON"),
+                        help="chunk size of the output (default: 120 months and 128x128 cells)")
+    parser.add_argument("--output-dtype", type=str, default=None, choices=['float32','float64'],
+                        help="dtype of the index in the output (default: dtype of the calculation)")
+    parser.add_argument("--frames", action="store_true",
+                        help="also save each movie frame as a png in figures/")
+    parser.add_argument("--append", type=str, default=None, metavar="FILE",
+                        help="add the new months of the input to an SPI file of a previous run,"+
+                        " with its distribution, timescales and calibration period")
+    options = parser.parse_args()
+    dataset_type = options.dataset_type
+    index_names = options.index
+    dataset_name = options.dataset_name
+    bounding_box = options.bounding_box
+    distribution = options.distribution
+    periodicity = options.periodicity
+    scales = options.scales
+    data_start_year = options.data_start_year
+    data_end_year = options.data_end_year
+    calibration_start_year = options.calibration_start_year
+    calibration_end_year = options.calibration_end_year
+    dir_out = options.dir_out
+    fig = options.fig
 
     #Test
 #    dataset_type = 'GLDAS'
@@ -754,12 +2028,14 @@ if __name__ == "__main__":
         raise ValueError("Dataset type not a valid entry. Use either 'CHIRPS', 'GLDAS', 'FLDAS'")
     #possible indices
     index_list = ['SPI', 'PET', 'SPEI']
-    if index not in index_list:
+    if len(index_names) == 0 or not all(index in index_list for index in index_names):
         raise ValueError("Index is not a valid entry. Enter either 'SPI', 'PET' or 'SPEI'")
+    if len(set(index_names)) != len(index_names):
+        raise ValueError("Each index should be requested once")
 
     #Some combinations are invalid
     if dataset_type == 'CHIRPS':
-        if index in ['PET','SPEI']:
+        if 'PET' in index_names or 'SPEI' in index_names:
             raise ValueError("Index calculation not supported for this dataset.")
     #beginning and end years
     if calibration_start_year != 'beginning':
@@ -776,39 +2052,60 @@ if __name__ == "__main__":
     if periodicity !='monthly':
         raise ValueError("Periodicity parameter should be set to monthly")
     #Scales
-    if scales not in [6,12]:
-        raise ValueError('Scales should be 6 or 12')
+    if not all(isinstance(scale, int) and scale >= 1 for scale in np.atleast_1d(scales).tolist()):
+        raise ValueError('Scales should be positive numbers of months')
     #distirbutions
     dist_list=['gamma','pearson']
     if distribution not in dist_list:
         raise ValueError("Valid distriubtion is 'gamma' or 'pearson'")
     ## Open datasets
+    years = None
+    if index_names == ['SPI']:
+        years = requiredYears('SPI', scales, data_start_year, data_end_year,
+                              calibration_start_year, calibration_end_year)
+    if options.append is not None:
+        years = None
+    dtype = 'float32' if options.float32 == True else 'float64'
+    load_dtype = 'float32' if options.float32 == True else None
+    da_temp = None
     if dataset_type == 'CHIRPS':
-        da_precip = openCHIRPS(dataset_name, bounding_box)
+        da_precip = openCHIRPS(dataset_name, bounding_box, load_dtype)
     elif dataset_type == 'GLDAS':
         if dataset_name.endswith('.nc')==True:
-            da_precip,da_temp = openGLDAS(dataset_name, bounding_box, periodicity, True)
+            da_precip,da_temp = openGLDAS(dataset_name, bounding_box, periodicity, True, None, load_dtype)
         else:
-            da_precip,da_temp = openGLDAS(dataset_name, bounding_box, periodicity, False)
+            da_precip,da_temp = openGLDAS(dataset_name, bounding_box, periodicity, False, years, load_dtype,
+                                        options.cache)
     elif dataset_type == 'FLDAS':
         if dataset_name.endswith('.nc')==True:
-            da_precip,da_temp = openFLDAS(dataset_name, bounding_box, periodicity, True)
+            da_precip,da_temp = openFLDAS(dataset_name, bounding_box, periodicity, True, None, load_dtype)
         else:
-            da_precip,da_temp = openFLDAS(dataset_name, bounding_box, periodicity, False)
+            da_precip,da_temp = openFLDAS(dataset_name, bounding_box, periodicity, False, years, load_dtype,
+                                        options.cache)
     ## Perform calcuculations
-    if index == 'SPI':
-        ds, info = SPI(da_precip, distribution, periodicity, scales,\
-                           data_start_year, data_end_year, calibration_start_year, calibration_end_year)
-    elif index == 'PET':
-        ds, da_pet, info = PET(da_temp,data_start_year,data_end_year)
-    elif index == 'SPEI':
-        ds, info = SPEI(da_precip, da_temp,distribution, periodicity, scales,\
-                            data_start_year, data_end_year, calibration_start_year, calibration_end_year)
+    cache = None
+    if options.cache is not None:
+        cache = {'directory': options.cache,
+                 'dataset': dataset_type+':'+os.path.abspath(dataset_name)}
+    if options.append is not None:
+        if index_names != ['SPI']:
+            raise ValueError('Append mode is only available for SPI')
+        new_time = appendIndex(options.append, da_precip, cache, dtype)
+        print('Appended '+str(np.size(new_time))+' months to '+options.append)
+        sys.exit(0)
+    args = (distribution, periodicity, scales, data_start_year, data_end_year,\
+            calibration_start_year, calibration_end_year, cache, dtype)
+    results = computeIndicesTiled(index_names, None if index_names == ['PET'] else da_precip,\
+                                  None if index_names == ['SPI'] else da_temp,\
+                                  args, options.workers, options.tile)
     ## Write to file
-    to_netcdfMint(ds, info, dataset_type, bounding_box, dir_out)
+    for ds, info in results:
+        to_netcdfMint(ds, info, dataset_type, bounding_box, dir_out,
+                      options.complevel, options.chunks, options.output_dtype)
     ## Do vizualization if asked
     if fig == True:
-        if index == 'PET':
-            print("Visualization is not supported")
-        else:
-            visualizeDroughtIndex(ds, dir_out, info, dataset_type)
+        for index, (ds, info) in zip(index_names, results):
+            if index == 'PET':
+                print("Visualization is not supported")
+            else:
+                visualizeDroughtIndex(ds, dir_out, info, dataset_type, options.frames)
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Regression check and benchmark suite for the flood severity index.
+
+Compares calculateIndex against the original cell-by-cell implementation on
+synthetic data. The benchmark writes a synthetic GloFAS cube and threshold
+grid to disk and times openDataset, calculateIndex, writeNetcdf and
+visualizeFlood separately, reporting the throughput and peak RSS of each
+stage. The results are saved as JSON so they can be compared over time.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import tempfile
+import time as timer
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import get_context
+
+import numpy as np
+import xarray as xr
+
+from FloodSeverityIndex import calculateIndex, openDataset, writeNetcdf, visualizeFlood
+
+STAGES = ['openDataset', 'calculateIndex', 'writeNetcdf', 'visualizeFlood']
+
+def calculateIndexLoop(val, Q2, Q5, Q20, lat, lon, time):
+    '''Reference (loop) implementation of calculateIndex
+
+    Kept as the ground truth for the vectorized classifier.
+
+    Args:
+       val (numpy array): Q values cut to the bounding box
+       Q2 (numpy array): Threshold Q for a 2-yr flood
+       Q5 (numpy array): Theshold Q for a 5-yr flood
+       Q20 (numpy array): Threshold Q for a 20-yr flood
+       lat (numpy array): latitude vector
+       lon (numpy array): longitude vector
+       time (numpy array): time vector
+
+    Returns:
+        flood_bool (numpy array): the boolean index for flood severity
+    '''
+    flood_bool = np.zeros(np.shape(val))
+
+    for idx_time, i_time in enumerate(time):
+        for idx_lat, i_lat in enumerate(lat):
+            for idx_lon, i_lon in enumerate(lon):
+                if val[idx_time,idx_lat,idx_lon]>=Q20[idx_lat,idx_lon]:
+                    flood_bool[idx_time,idx_lat,idx_lon]= 3
+                elif val[idx_time,idx_lat,idx_lon]<Q2[idx_lat,idx_lon]:
+                    flood_bool[idx_time,idx_lat,idx_lon] = 0
+                elif val[idx_time,idx_lat,idx_lon]>=Q2[idx_lat,idx_lon] and val[idx_time,idx_lat,idx_lon]<Q5[idx_lat,idx_lon]:
+                    flood_bool[idx_time,idx_lat,idx_lon] = 1
+                elif val[idx_time,idx_lat,idx_lon]>=Q5[idx_lat,idx_lon] and val[idx_time,idx_lat,idx_lon]<Q20[idx_lat,idx_lon]:
+                    flood_bool[idx_time,idx_lat,idx_lon] = 2
+                elif np.isnan(val[idx_time,idx_lat,idx_lon]):
+                    flood_bool[idx_time,idx_lat,idx_lon] = np.nan
+
+    return flood_bool
+
+def syntheticData(ntime, nlat, nlon, nan_fraction=0.1, seed=0):
+    '''Generate a synthetic discharge cube and threshold grids
+
+    Some threshold cells are set to NaN as well, to exercise the
+    fall-through branch of the classifier.
+
+    Args:
+        ntime (int): number of time steps
+        nlat (int): number of latitudes
+        nlon (int): number of longitudes
+        nan_fraction (float): fraction of missing discharge values
+        seed (int): seed for the random number generator
+
+    Returns:
+        val, Q2, Q5, Q20, lat, lon, time in the format returned by openDataset
+    '''
+    rng = np.random.default_rng(seed)
+    Q2 = rng.gamma(2., 50., size=(nlat,nlon))
+    Q5 = Q2*rng.uniform(1.1, 1.5, size=(nlat,nlon))
+    Q20 = Q5*rng.uniform(1.1, 1.5, size=(nlat,nlon))
+    Q20[rng.random((nlat,nlon))<nan_fraction/10] = np.nan
+    val = rng.gamma(2., 50., size=(ntime,nlat,nlon))*rng.uniform(0.2, 2.5, size=(ntime,1,1))
+    val[rng.random((ntime,nlat,nlon))<nan_fraction] = np.nan
+    # hit the thresholds exactly on some cells to check the boundaries
+    val[0,:,:] = Q2
+    if ntime > 1:
+        val[1,:,:] = Q5
+    if ntime > 2:
+        val[2,:,:] = Q20
+    lat = np.linspace(15, 3, nlat)
+    lon = np.linspace(23, 48, nlon)
+    time = np.datetime64('2017-01-01', 'ns')+np.arange(ntime).astype('timedelta64[D]')
+
+    return val, Q2, Q5, Q20, lat, lon, time
+
+def checkRegression(ntime=20, nlat=40, nlon=50, nan_fraction=0.1):
+    '''Check that calculateIndex is bit-identical to the loop version
+
+    Raises:
+        AssertionError: if the two implementations differ
+    '''
+    args = syntheticData(ntime, nlat, nlon, nan_fraction)
+    ref = calculateIndexLoop(*args)
+    new = calculateIndex(*args)
+    assert new.dtype == ref.dtype, 'dtype differs: '+str(new.dtype)+' vs '+str(ref.dtype)
+    assert np.array_equal(new, ref, equal_nan=True), 'Flood categories differ from the loop version'
+
+def throughput(func, args, repeat=3):
+    '''Best-of-n throughput of a classifier in cells/second'''
+    best = np.inf
+    for i in range(repeat):
+        start = timer.perf_counter()
+        func(*args)
+        best = min(best, timer.perf_counter()-start)
+    return np.size(args[0])/best
+
+def writeSynthetic(directory, ntime, nlat, nlon, nan_fraction=0.1, seed=0):
+    '''Write a synthetic GloFAS file and threshold file for the benchmark
+
+    Args:
+        directory (str): folder receiving glofas.nc and thresholds.nc
+        ntime (int): number of time steps
+        nlat (int): number of latitudes
+        nlon (int): number of longitudes
+        nan_fraction (float): fraction of missing discharge values
+        seed (int): seed for the random number generator
+
+    Returns:
+        data (str): name of the GloFAS file (dis24, all years in one file)
+        thresholds (str): name of the threshold file (Q_2, Q_5, Q_20)
+        year (list): years covered by the data
+        bounding_box (list): min_lon, max_lon, min_lat, max_lat
+    '''
+    val, Q2, Q5, Q20, lat, lon, time = syntheticData(ntime, nlat, nlon, nan_fraction, seed)
+    data = os.path.join(directory, 'glofas.nc')
+    thresholds = os.path.join(directory, 'thresholds.nc')
+    xr.Dataset({'dis24': (('time','lat','lon'), val.astype('float32'))},
+               coords={'time': time, 'lat': lat, 'lon': lon}).to_netcdf(data)
+    xr.Dataset({'Q_2': (('lat','lon'), Q2), 'Q_5': (('lat','lon'), Q5),
+                'Q_20': (('lat','lon'), Q20)},
+               coords={'lat': lat, 'lon': lon}).to_netcdf(thresholds)
+    years = time.astype('datetime64[Y]').astype(int)+1970
+    year = list(range(int(years.min()), int(years.max())+1))
+    bounding_box = [float(lon.min()), float(lon.max()), float(lat.min()), float(lat.max())]
+
+    return data, thresholds, year, bounding_box
+
+def peakRSS():
+    '''Peak resident set size of the current process in MB'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+def runStage(stage, directory, data, thresholds, year, bounding_box, viz_days=30):
+    '''Time one stage of the flood severity index
+
+    Runs in a fresh process so the peak RSS belongs to this stage only. The
+    inputs of a stage (e.g. the cube for calculateIndex) are prepared before
+    the clock starts, so the reported peak RSS includes them.
+
+    Args:
+        stage (str): one of STAGES
+        directory (str): working directory, receiving ./results
+        data (str): GloFAS file written by writeSynthetic
+        thresholds (str): threshold file written by writeSynthetic
+        year (list): years covered by the data
+        bounding_box (list): min_lon, max_lon, min_lat, max_lat
+        viz_days (int): number of days rendered by visualizeFlood
+
+    Returns:
+        result (dict): seconds, throughput, unit and peak_rss_mb of the stage
+    '''
+    os.chdir(directory)
+    if stage != 'openDataset':
+        val, Q2, Q5, Q20, lat, lon, time = openDataset(data, thresholds, year, bounding_box)
+    if stage == 'writeNetcdf' or stage == 'visualizeFlood':
+        flood_bool = calculateIndex(val, Q2, Q5, Q20, lat, lon, time)
+
+    start = timer.perf_counter()
+    if stage == 'openDataset':
+        val, Q2, Q5, Q20, lat, lon, time = openDataset(data, thresholds, year, bounding_box)
+    elif stage == 'calculateIndex':
+        flood_bool = calculateIndex(val, Q2, Q5, Q20, lat, lon, time)
+    elif stage == 'writeNetcdf':
+        writeNetcdf(flood_bool, lat, lon, time, 'benchmark')
+    elif stage == 'visualizeFlood':
+        visualizeFlood(flood_bool[:viz_days], lat, lon, time[:viz_days])
+    seconds = timer.perf_counter()-start
+
+    if stage == 'visualizeFlood':
+        count, unit = min(viz_days, np.size(time)), 'frames/s'
+    else:
+        count, unit = np.size(val), 'cells/s'
+
+    return {'seconds': seconds, 'throughput': count/seconds, 'unit': unit,
+            'peak_rss_mb': peakRSS()}
+
+def benchmark(shape, nan_fraction=0.1, stages=STAGES, viz_days=30, directory=None):
+    '''Run the benchmark suite on a synthetic cube
+
+    Args:
+        shape (list): time, lat, lon size of the synthetic cube
+        nan_fraction (float): fraction of missing discharge values
+        stages (list): stages to time, among STAGES
+        viz_days (int): number of days rendered by visualizeFlood
+        directory (str): working directory. A temporary one is used if None
+
+    Returns:
+        report (dict): benchmark configuration and results of each stage
+    '''
+    tmp = None
+    if directory is None:
+        tmp = tempfile.TemporaryDirectory()
+        directory = tmp.name
+    directory = os.path.abspath(directory)
+    data, thresholds, year, bounding_box = writeSynthetic(directory, *shape, nan_fraction=nan_fraction)
+
+    report = {'date': datetime.now().isoformat(timespec='seconds'),
+              'platform': platform.platform(),
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'xarray': xr.__version__,
+              'shape': list(shape),
+              'nan_fraction': nan_fraction,
+              'stages': {}}
+    for stage in stages:
+        with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as pool:
+            result = pool.submit(runStage, stage, directory, data, thresholds,
+                                 year, bounding_box, viz_days).result()
+        report['stages'][stage] = result
+        print('%-15s %8.3f s  %.3e %s  peak RSS %8.1f MB' %
+              (stage, result['seconds'], result['throughput'], result['unit'], result['peak_rss_mb']))
+
+    if tmp is not None:
+        tmp.cleanup()
+
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shape", type=int, nargs=3, default=[365,120,100],
+                        help="time lat lon size of the synthetic cube")
+    parser.add_argument("--nan", type=float, default=0.1,
+                        help="fraction of missing discharge values")
+    parser.add_argument("--loop", action="store_true",
+                        help="also time the loop implementation (slow)")
+    parser.add_argument("--stages", type=str, nargs='+', default=STAGES, choices=STAGES,
+                        help="stages to benchmark (default: all)")
+    parser.add_argument("--viz-days", type=int, default=30,
+                        help="number of days rendered when timing visualizeFlood")
+    parser.add_argument("--directory", type=str, default=None,
+                        help="working directory for the synthetic files (default: temporary)")
+    parser.add_argument("--output", type=str, default='FSI_benchmark.json',
+                        help="JSON file receiving the results")
+    options = parser.parse_args()
+
+    checkRegression(nan_fraction=options.nan)
+    print('Regression check passed: vectorized and loop categories are identical')
+
+    args = syntheticData(*options.shape, nan_fraction=options.nan)
+    print('calculateIndex: %.3e cells/s' % throughput(calculateIndex, args))
+    if options.loop:
+        print('loop version: %.3e cells/s' % throughput(calculateIndexLoop, args, repeat=1))
+
+    report = benchmark(options.shape, options.nan, options.stages, options.viz_days,
+                       options.directory)
+    with open(options.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Results saved to '+options.output)
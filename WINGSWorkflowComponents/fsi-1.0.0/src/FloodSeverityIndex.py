@@ -17,65 +17,167 @@ import glob as glob
 from datetime import date
 import sys
 import ast
+import argparse
 import pandas as pd
 import cartopy.crs as ccrs
 import cartopy.feature as cfeature
 import matplotlib.pyplot as plt
 import os
+import re
+import json
+import hashlib
+import netCDF4
+from concurrent.futures import ProcessPoolExecutor
 import imageio
 import matplotlib.ticker as mticker
 from cartopy.mpl.gridliner import LONGITUDE_FORMATTER, LATITUDE_FORMATTER
 
-def openDataset(data, thresholds, year, bounding_box):
-    ''' Open the thresholds and GloFAS concatenated dataset for the appropriate year
+def openGloFAS(data, year, bounding_box):
+    ''' Lazily open the GloFAS data and cut it to the bounding box
+
+    Nothing is read from disk until the values are requested, so the result
+    can be sliced further before loading.
 
     Args:
-        data (str): path to GloFAS in netcdf format. All years in one file
-        thresholds (str): Name of the netcdf file containing the thresholds data
-        year (list): year to consider
+        data (str): path to GloFAS in netcdf format. Either one file with all
+            years (ending in .nc) or a folder organized in yearly folders
+        year (list or int): years to consider. A single year when data is
+            organized in yearly folders
         bounding_box (list): min_lon, max_lon, min_lat, max_lat
 
     Returns:
-        val (numpy array): Q values cut to the bounding box
-        Q2 (numpy array): Threshold Q for a 2-yr flood
-        Q5 (numpy array): Theshold Q for a 5-yr flood
-        Q20 (numpy array): Threshold Q for a 20-yr flood
-        lat (numpy array): latitude vector
-        lon (numpy array): longitude vector
-        time (numpy array): time vector
+        p_ (xarray Dataset): GloFAS dataset cut to the bounding box
     '''
-    data = xr.open_dataset(data)
-    min_year = np.min(year)
-    min_time = str(min_year)+'-01-01T00:00:00.000000000'
-    max_year = np.max(year)
-    max_time = str(max_year)+'-12-31T00:00:00.000000000'
+    if data.endswith('.nc')==True:
+        data = xr.open_dataset(data)
+        min_year = np.min(year)
+        min_time = str(min_year)+'-01-01T00:00:00.000000000'
+        max_year = np.max(year)
+        max_time = str(max_year)+'-12-31T00:00:00.000000000'
+        p_ = data.sel(lat=slice(bounding_box[3], bounding_box[2]),\
+                      lon=slice(bounding_box[0],bounding_box[1]),
+                      time = slice(min_time,max_time))
+    else:
+        # path + folders
+        path = data+'/'+str(year)
+        file_names = sorted(glob.glob(path+'/*.nc'))
+        p_ = openGloFASFiles(file_names, bounding_box)
+
+    return p_
+
+def openGloFASFiles(file_names, bounding_box):
+    ''' Lazily open a list of GloFAS files and cut them to the bounding box
+
+    Args:
+        file_names (list): GloFAS netcdf files, in time order
+        bounding_box (list): min_lon, max_lon, min_lat, max_lat
+
+    Returns:
+        p_ (xarray Dataset): GloFAS dataset cut to the bounding box
+    '''
+    data = xr.open_mfdataset(file_names)
     p_ = data.sel(lat=slice(bounding_box[3], bounding_box[2]),\
-                  lon=slice(bounding_box[0],bounding_box[1]),
-                  time = slice(min_time,max_time))
-    val = p_.dis24.values
-    #open thresholds
+                  lon=slice(bounding_box[0],bounding_box[1]))
+
+    return p_
+
+def stackThresholds(thresholds, bounding_box):
+    ''' Open the flood thresholds and stack them into one array
+
+    Args:
+        thresholds (str): Name of the netcdf file containing the thresholds data
+        bounding_box (list): min_lon, max_lon, min_lat, max_lat
+
+    Returns:
+        Q (numpy array): contiguous (3, lat, lon) array with the threshold Q
+            for a 2-yr, 5-yr and 20-yr flood, cut to the bounding box
+    '''
     thres = xr.open_dataset(thresholds)
     t_ = thres.sel(lat=slice(bounding_box[3], bounding_box[2]),\
                   lon=slice(bounding_box[0],bounding_box[1]))
-    Q5 = t_['Q_5'].values
-    Q2 = t_['Q_2'].values
-    Q20 = t_['Q_20'].values
+    Q = np.ascontiguousarray(np.stack([t_['Q_2'].values,
+                                       t_['Q_5'].values,
+                                       t_['Q_20'].values]))
+    thres.close()
 
-    lat = p_['lat'].values
-    lon = p_['lon'].values
-    time = p_['time'].values
+    return Q
 
-    return val, Q2, Q5, Q20, lat, lon, time
-    
+# thresholds already loaded by this process, by cache key
+loaded_thresholds = {}
+
+def loadThresholds(thresholds, bounding_box, cache_dir=None):
+    ''' Load the stacked flood thresholds for a bounding box, with caching
 
-def openDatasets(data,thresholds,year,bounding_box):
-    '''Open the thresholds and GloFAS datasets for the appropriate year
+    The thresholds are cut and stacked once per bounding box and saved as
+    a .npy file in cache_dir, keyed by the thresholds file (path, size and
+    modification time) and the bounding box. Later calls, including other
+    runs over the same region, memory-map that file instead of decoding
+    the netcdf.
 
     Args:
-        data (str): path to GloFAS in netcdf format. Data needs to be oragnized in yearly folders
+        thresholds (str): Name of the netcdf file containing the thresholds data
+        bounding_box (list): min_lon, max_lon, min_lat, max_lat
+        cache_dir (str): directory of the cache (the --cache option). Default is
+            None (no disk cache, the thresholds are only kept in memory)
+
+    Returns:
+        Q (numpy array): (3, lat, lon) array, see stackThresholds
+    '''
+    stat = os.stat(thresholds)
+    key = repr((os.path.abspath(thresholds), stat.st_size, stat.st_mtime,
+                [float(b) for b in bounding_box]))
+    if key in loaded_thresholds:
+        return loaded_thresholds[key]
+
+    if cache_dir is None:
+        Q = stackThresholds(thresholds, bounding_box)
+    else:
+        filename = os.path.join(cache_dir, 'thresholds_'+\
+                                hashlib.sha1(key.encode()).hexdigest()+'.npy')
+        if os.path.isfile(filename) is False:
+            if os.path.isdir(cache_dir) is False:
+                os.makedirs(cache_dir, exist_ok=True)
+            # write to a temporary file first so concurrent runs never
+            # see a partial cache
+            tmp = filename+'.'+str(os.getpid())
+            with open(tmp, 'wb') as f:
+                np.save(f, stackThresholds(thresholds, bounding_box))
+            os.replace(tmp, filename)
+        Q = np.load(filename, mmap_mode='r')
+
+    loaded_thresholds[key] = Q
+
+    return Q
+
+def openThresholds(thresholds, bounding_box, cache_dir=None):
+    ''' Open the flood thresholds and cut them to the bounding box
+
+    Args:
+        thresholds (str): Name of the netcdf file containing the thresholds data
+        bounding_box (list): min_lon, max_lon, min_lat, max_lat
+        cache_dir (str): directory of the threshold cache, see loadThresholds.
+            Default is None (no disk cache)
+
+    Returns:
+        Q2 (numpy array): Threshold Q for a 2-yr flood
+        Q5 (numpy array): Theshold Q for a 5-yr flood
+        Q20 (numpy array): Threshold Q for a 20-yr flood
+    '''
+    Q = loadThresholds(thresholds, bounding_box, cache_dir)
+
+    return Q[0], Q[1], Q[2]
+
+def openDataset(data, thresholds, year, bounding_box, cache_dir=None):
+    ''' Open the thresholds and GloFAS concatenated dataset for the appropriate year
+
+    Args:
+        data (str): path to GloFAS in netcdf format. Either one file with all
+            years (ending in .nc) or a folder organized in yearly folders
         thresholds (str): Name of the netcdf file containing the thresholds data
         year (list): year to consider
         bounding_box (list): min_lon, max_lon, min_lat, max_lat
+        cache_dir (str): directory of the threshold cache, see loadThresholds.
+            Default is None (no disk cache)
 
     Returns:
         val (numpy array): Q values cut to the bounding box
@@ -86,26 +188,10 @@ def openDatasets(data,thresholds,year,bounding_box):
         lon (numpy array): longitude vector
         time (numpy array): time vector
     '''
-    # path + folders
-    path = data+'/'+str(year)
-    nc_files = (glob.glob(path+'/*.nc'))
-    file_names=[]
-    for file in nc_files:
-        file_names.append(file)
-    file_names.sort()
-    #open
-    data = xr.open_mfdataset(file_names)
-    p_ = data.sel(lat=slice(bounding_box[3], bounding_box[2]),\
-                  lon=slice(bounding_box[0],bounding_box[1]))
+    p_ = openGloFAS(data, year, bounding_box)
     val = p_.dis24.values
-
     #open thresholds
-    thres = xr.open_dataset(thresholds)
-    t_ = thres.sel(lat=slice(bounding_box[3], bounding_box[2]),\
-                  lon=slice(bounding_box[0],bounding_box[1]))
-    Q5 = t_['Q_5'].values
-    Q2 = t_['Q_2'].values
-    Q20 = t_['Q_20'].values
+    Q2, Q5, Q20 = openThresholds(thresholds, bounding_box, cache_dir)
 
     lat = p_['lat'].values
     lon = p_['lon'].values
@@ -113,6 +199,9 @@ def openDatasets(data,thresholds,year,bounding_box):
 
     return val, Q2, Q5, Q20, lat, lon, time
 
+# yearly folders are opened the same way as a file with all the years
+openDatasets = openDataset
+
 def calculateIndex(val, Q2, Q5, Q20, lat, lon, time):
     '''Calculate a flooding index based on threshold levels
 
@@ -133,25 +222,92 @@ def calculateIndex(val, Q2, Q5, Q20, lat, lon, time):
 
     '''
 # put a boolean for flood level, 0: no flood, 1: Q2, 2: Q5, 3: Q20
-    flood_bool = np.zeros(np.shape(val))
-
-    for idx_time, i_time in enumerate(time):
-        for idx_lat, i_lat in enumerate(lat):
-            for idx_lon, i_lon in enumerate(lon):
-                if val[idx_time,idx_lat,idx_lon]>=Q20[idx_lat,idx_lon]:
-                    flood_bool[idx_time,idx_lat,idx_lon]= 3
-                elif val[idx_time,idx_lat,idx_lon]<Q2[idx_lat,idx_lon]:
-                    flood_bool[idx_time,idx_lat,idx_lon] = 0
-                elif val[idx_time,idx_lat,idx_lon]>=Q2[idx_lat,idx_lon] and val[idx_time,idx_lat,idx_lon]<Q5[idx_lat,idx_lon]:
-                    flood_bool[idx_time,idx_lat,idx_lon] = 1
-                elif val[idx_time,idx_lat,idx_lon]>=Q5[idx_lat,idx_lon] and val[idx_time,idx_lat,idx_lon]<Q20[idx_lat,idx_lon]:
-                    flood_bool[idx_time,idx_lat,idx_lon] = 2
-                elif np.isnan(val[idx_time,idx_lat,idx_lon]):
-                    flood_bool[idx_time,idx_lat,idx_lon] = np.nan
+    # The conditions are evaluated in the same order as the original cell by
+    # cell test so that the first match wins; cells that match none of them
+    # (e.g. missing thresholds) stay at 0.
+    val = np.asarray(val)
+    Q2 = np.asarray(Q2)[np.newaxis,:,:]
+    Q5 = np.asarray(Q5)[np.newaxis,:,:]
+    Q20 = np.asarray(Q20)[np.newaxis,:,:]
+
+    conditions = [val>=Q20,
+                  val<Q2,
+                  (val>=Q2) & (val<Q5),
+                  (val>=Q5) & (val<Q20),
+                  np.isnan(val)]
+    choices = [3., 0., 1., 2., np.nan]
+    flood_bool = np.select(conditions, choices, default=0.)
 
     return flood_bool
 
-def writeNetcdf(flood_bool, lat, lon, time, year):
+def floodAttributes(lat, lon):
+    ''' Attributes of the flood variable and of the flood index dataset
+
+    Args:
+        lat (numpy array): Vector of latitudes
+        lon (numpy array): Vector of longtidues
+
+    Returns:
+        var_attrs (dict): attributes of the flood variable
+        global_attrs (dict): global attributes of the dataset. The time
+            coverage is added by the writers.
+    '''
+    var_attrs = {}
+    var_attrs['title'] = 'Flood level Severity (medium, high, and severe)'
+    var_attrs['long_name'] = 'Flood Level Severity'
+    var_attrs['units'] = 'unitless'
+    var_attrs['valid_min'] = 0
+    var_attrs['valid_max'] = 3
+    var_attrs['missing_value'] = np.nan
+    var_attrs['standard_name'] = 'channel_water_flow__flood_volume-flux_severity_index'
+
+    global_attrs = {}
+    global_attrs['title'] = "Flood Severity"
+    global_attrs['summary'] = 'Flood severity index: medium (2-yr flood, index=1),'+\
+        'high (5-yr flood, index=2), and severe (20-yr flood, index=3), inferred from'+\
+        'the GloFAS dataset. Thresholds were determined by fitting a Gumbel extreme'+\
+        ' value distribution to the yearly maxima in each grid cell over 1981-2017.'
+    global_attrs['date_created'] = str(date.today())
+    global_attrs['creator_name'] = 'Deborah Khider'
+    global_attrs['creator_email'] = 'khider@usc.edu'
+    global_attrs['institution'] = 'USC Information Sciences Institute'
+    global_attrs['geospatial_lat_min'] = np.min(lat)
+    global_attrs['geospatial_lat_max'] = np.max(lat)
+    global_attrs['geospatial_lon_min'] = np.min(lon)
+    global_attrs['geospatial_lon_max'] = np.max(lon)
+
+    return var_attrs, global_attrs
+
+FILL_VALUE = -1
+TIME_UNITS = 'hours since 1970-01-01 00:00:00'
+CHUNK_SHAPE = (366, 32, 32)
+
+def floodEncoding(shape):
+    ''' Compact netcdf encoding of the flood variable
+
+    The categories are stored as int8 with FILL_VALUE for missing cells and
+    compressed with zlib/shuffle. Chunks span up to a year of days over small
+    spatial tiles, so reading the time series of a region touches few chunks.
+
+    Args:
+        shape (tuple): time, lat and lon size. Use None for an unlimited time axis.
+
+    Returns:
+        encoding (dict): xarray encoding of the flood variable
+    '''
+    ntime = CHUNK_SHAPE[0] if shape[0] is None else max(1, min(shape[0], CHUNK_SHAPE[0]))
+    encoding = {'dtype': 'int8',
+                '_FillValue': FILL_VALUE,
+                'zlib': True,
+                'shuffle': True,
+                'complevel': 4,
+                'chunksizes': (ntime,
+                               min(shape[1], CHUNK_SHAPE[1]),
+                               min(shape[2], CHUNK_SHAPE[2]))}
+
+    return encoding
+
+def writeNetcdf(flood_bool, lat, lon, time, year, compact=False):
     ''' Write netcdf with the flooding index
 
     Args:
@@ -160,31 +316,20 @@ def writeNetcdf(flood_bool, lat, lon, time, year):
         lon (numpy array): Vector of longtidues
         time (numpy array): Vector of time
         year (int): year of interest
+        compact (bool): store the index as compressed int8 (see floodEncoding)
+            instead of float64
     '''
+    var_attrs, global_attrs = floodAttributes(lat, lon)
+    encoding = None
+    if compact == True:
+        encoding = {'flood': floodEncoding(np.shape(flood_bool))}
+        var_attrs['missing_value'] = np.int8(FILL_VALUE)
     #write as a data array
     da_flood = xr.DataArray(flood_bool,coords=[time,lat,lon],dims=['time','lat','lon'])
-    da_flood.attrs['title'] = 'Flood level Severity (medium, high, and severe)'
-    da_flood.attrs['long_name'] = 'Flood Level Severity'
-    da_flood.attrs['units'] = 'unitless'
-    da_flood.attrs['valid_min'] = 0
-    da_flood.attrs['valid_max'] = 3
-    da_flood.attrs['missing_value'] = np.nan
-    da_flood.attrs['standard_name'] = 'channel_water_flow__flood_volume-flux_severity_index'
+    da_flood.attrs.update(var_attrs)
 
     ds = da_flood.to_dataset(name='flood')
-    ds.attrs['title'] = "Flood Severity"
-    ds.attrs['summary'] = 'Flood severity index: medium (2-yr flood, index=1),'+\
-        'high (5-yr flood, index=2), and severe (20-yr flood, index=3), inferred from'+\
-        'the GloFAS dataset. Thresholds were determined by fitting a Gumbel extreme'+\
-        ' value distribution to the yearly maxima in each grid cell over 1981-2017.'
-    ds.attrs['date_created'] = str(date.today())
-    ds.attrs['creator_name'] = 'Deborah Khider'
-    ds.attrs['creator_email'] = 'khider@usc.edu'
-    ds.attrs['institution'] = 'USC Information Sciences Institute'
-    ds.attrs['geospatial_lat_min'] = np.min(lat)
-    ds.attrs['geospatial_lat_max'] = np.max(lat)
-    ds.attrs['geospatial_lon_min'] = np.min(lon)
-    ds.attrs['geospatial_lon_max'] = np.max(lon)
+    ds.attrs.update(global_attrs)
     ds.attrs['time_coverage_start'] = str(ds.time.values[0])
     ds.attrs['time_coverage_end'] = str(ds.time.values[-1])
     ds.attrs['time_coverage_resolution'] = 'daily'
@@ -192,86 +337,1026 @@ def writeNetcdf(flood_bool, lat, lon, time, year):
     if os.path.isdir('./results') is False:
         os.makedirs('./results')
 
-    ds.to_netcdf('./results/GloFAS_FloodIndex_'+str(year)+'.nc')
+    # unlimited time so that new days can be appended in place (see updateIndex)
+    if encoding is None:
+        encoding = {}
+    encoding['time'] = {'units': TIME_UNITS, 'calendar': 'proleptic_gregorian', 'dtype': 'f8'}
+    ds.to_netcdf('./results/GloFAS_FloodIndex_'+str(year)+'.nc', encoding=encoding,
+                 unlimited_dims=['time'])
+
+#%% Streaming (out-of-core) mode
+
+def createNetcdf(lat, lon, year, compact=False, directory='./results'):
+    ''' Create an empty flood index netcdf with an unlimited time dimension
+
+    The file is filled chunk by chunk with appendNetcdf and finalized with
+    closeNetcdf.
+
+    Args:
+        lat (numpy array): Vector of latitudes
+        lon (numpy array): Vector of longtidues
+        year (int): year of interest
+        compact (bool): store the index as compressed int8 (see floodEncoding)
+            instead of float64
+        directory (str): output directory. Default is ./results
+
+    Returns:
+        nc (netCDF4 Dataset): the open output file
+    '''
+    if os.path.isdir(directory) is False:
+        os.makedirs(directory)
+
+    var_attrs, global_attrs = floodAttributes(lat, lon)
+    nc = netCDF4.Dataset(directory+'/GloFAS_FloodIndex_'+str(year)+'.nc', 'w')
+    nc.createDimension('time', None)
+    nc.createDimension('lat', np.size(lat))
+    nc.createDimension('lon', np.size(lon))
+    nc_time = nc.createVariable('time', 'f8', ('time',))
+    nc_time.units = TIME_UNITS
+    nc_time.calendar = 'proleptic_gregorian'
+    nc.createVariable('lat', 'f8', ('lat',))[:] = lat
+    nc.createVariable('lon', 'f8', ('lon',))[:] = lon
+    if compact == True:
+        encoding = floodEncoding((None, np.size(lat), np.size(lon)))
+        nc_flood = nc.createVariable('flood', encoding['dtype'], ('time','lat','lon'),
+                                     fill_value=encoding['_FillValue'],
+                                     zlib=encoding['zlib'],
+                                     shuffle=encoding['shuffle'],
+                                     complevel=encoding['complevel'],
+                                     chunksizes=encoding['chunksizes'])
+        var_attrs['missing_value'] = np.int8(FILL_VALUE)
+    else:
+        nc_flood = nc.createVariable('flood', 'f8', ('time','lat','lon'),
+                                     fill_value=np.nan)
+    nc_flood.setncatts(var_attrs)
+    nc.setncatts(global_attrs)
+    nc.time_coverage_resolution = 'daily'
+
+    return nc
+
+def appendNetcdf(nc, flood_bool, time, lat_slice=slice(None), lon_slice=slice(None)):
+    ''' Write a chunk of the flooding index at the end of the time axis
+
+    Args:
+        nc (netCDF4 Dataset): file created by createNetcdf
+        flood_bool (numpy array): flood severity index for the chunk
+        time (numpy array): Vector of time for the chunk
+        lat_slice (slice): latitude indices covered by the chunk
+        lon_slice (slice): longitude indices covered by the chunk
+    '''
+    nc_time = nc['time']
+    values = netCDF4.date2num(pd.to_datetime(time).to_pydatetime(), nc_time.units,
+                              getattr(nc_time, 'calendar', 'standard'))
+    start = int(np.searchsorted(np.asarray(nc_time[:]), values[0]))
+    stop = start+np.size(time)
+    nc_time[start:stop] = values
+    # masked cells are written as the fill value, whatever the stored dtype; the
+    # NaN under the mask are zeroed so that netCDF4 does not cast them to int8
+    nc['flood'][start:stop, lat_slice, lon_slice] = np.ma.masked_array(
+        np.nan_to_num(flood_bool, nan=0), mask=np.isnan(flood_bool))
+
+def closeNetcdf(nc):
+    ''' Add the time coverage to a file created by createNetcdf and close it
+
+    Args:
+        nc (netCDF4 Dataset): file created by createNetcdf
+    '''
+    nc_time = nc['time']
+    coverage = netCDF4.num2date(nc_time[[0,-1]], nc_time.units,
+                                getattr(nc_time, 'calendar', 'standard'),
+                                only_use_cftime_datetimes=False,
+                                only_use_python_datetimes=True)
+    nc.time_coverage_start = str(np.datetime64(coverage[0], 'ns'))
+    nc.time_coverage_end = str(np.datetime64(coverage[-1], 'ns'))
+    nc.close()
+
+def calculateIndexChunked(data, thresholds, year, bounding_box, file_year,
+                          chunk_size=30, tile_size=None, compact=False, cache_dir=None):
+    ''' Stream GloFAS through calculateIndex and write the result incrementally
+
+    GloFAS is read chunk_size days at a time (and optionally in spatial tiles),
+    classified against the thresholds and appended to the output netcdf, so
+    that peak memory depends on the chunk size and not on the record length.
+
+    Args:
+        data (str): path to GloFAS in netcdf format. Either one file with all
+            years (ending in .nc) or a folder organized in yearly folders
+        thresholds (str): Name of the netcdf file containing the thresholds data
+        year (list or int): years to consider
+        bounding_box (list): min_lon, max_lon, min_lat, max_lat
+        file_year (str or int): year used to name the output file
+        chunk_size (int): number of days read at once
+        tile_size (list): number of latitudes and longitudes read at once.
+            Default is the full bounding box.
+        compact (bool): store the index as compressed int8
+        cache_dir (str): directory of the threshold cache, see loadThresholds.
+            Default is None (no disk cache)
+
+    Returns:
+        lat (numpy array): latitude vector
+        lon (numpy array): longitude vector
+        time (numpy array): time vector
+    '''
+    p_ = openGloFAS(data, year, bounding_box)
+    Q2, Q5, Q20 = openThresholds(thresholds, bounding_box, cache_dir)
+    lat = p_['lat'].values
+    lon = p_['lon'].values
+    time = p_['time'].values
+    if tile_size is None:
+        tile_size = [np.size(lat), np.size(lon)]
+
+    nc = createNetcdf(lat, lon, file_year, compact)
+    for t0 in range(0, np.size(time), chunk_size):
+        t_ = slice(t0, t0+chunk_size)
+        for y0 in range(0, np.size(lat), tile_size[0]):
+            y_ = slice(y0, y0+tile_size[0])
+            for x0 in range(0, np.size(lon), tile_size[1]):
+                x_ = slice(x0, x0+tile_size[1])
+                val = p_.dis24[t_,y_,x_].values
+                flood_bool = calculateIndex(val, Q2[y_,x_], Q5[y_,x_], Q20[y_,x_],
+                                            lat[y_], lon[x_], time[t_])
+                appendNetcdf(nc, flood_bool, time[t_], y_, x_)
+    closeNetcdf(nc)
+    p_.close()
+
+    return lat, lon, time
+
+#%% Flood events
+def runLengths(mask):
+    ''' Length of the current run of True values along the time axis
+
+    Run-length encoding without loops over cells: the cumulative count of
+    True values, minus its value at the last False.
+
+    Args:
+        mask (numpy array): boolean array (time x lat x lon)
+
+    Returns:
+        run (numpy array): for each day, the number of consecutive True
+            values ending on that day (0 where mask is False)
+    '''
+    count = np.cumsum(mask, axis=0)
+    reset = np.maximum.accumulate(np.where(mask, 0, count), axis=0)
+
+    return count-reset
+
+def floodEvents(flood_bool, lat, lon, time):
+    ''' Flood event statistics for each grid cell
+
+    An event is a run of consecutive days with a flood index of at least 1.
+    Missing days are not flooded and end an event.
+
+    Args:
+        flood_bool (numpy array): flood severity index (time x lat x lon)
+        lat (numpy array): latitude vector
+        lon (numpy array): longitude vector
+        time (numpy array): time vector
+
+    Returns:
+        ds (xarray Dataset): number of events, longest run at or above each
+            severity, first onset date and peak severity of each cell
+    '''
+    flood_bool = np.asarray(flood_bool)
+    flooded = flood_bool>=1
+    onset = flooded.copy()
+    onset[1:] &= ~flooded[:-1]
+    n_events = np.sum(onset, axis=0)
+
+    severity = [1,2,3]
+    longest = np.stack([runLengths(flood_bool>=s).max(axis=0) for s in severity])
+
+    first = np.argmax(flooded, axis=0)
+    first_onset = np.where(n_events>0, np.asarray(time)[first], np.datetime64('NaT'))
+    # all-missing cells keep a NaN peak
+    peak = np.where(np.isnan(flood_bool).all(axis=0), np.nan,
+                    np.max(np.where(np.isnan(flood_bool), -1, flood_bool), axis=0))
+
+    ds = xr.Dataset({'n_events': (('lat','lon'), n_events),
+                     'longest_event': (('severity','lat','lon'), longest),
+                     'first_onset': (('lat','lon'), first_onset),
+                     'peak': (('lat','lon'), peak)},
+                    coords={'severity': severity, 'lat': lat, 'lon': lon})
+    ds.n_events.attrs['long_name'] = 'Number of flood events'
+    ds.n_events.attrs['units'] = 'count'
+    ds.longest_event.attrs['long_name'] = 'Longest run of days at or above the flood severity'
+    ds.longest_event.attrs['units'] = 'days'
+    ds.first_onset.attrs['long_name'] = 'First day of the first flood event'
+    ds.peak.attrs['long_name'] = 'Peak flood level severity'
+    ds.peak.attrs['units'] = 'unitless'
+    ds.peak.attrs['valid_min'] = 0
+    ds.peak.attrs['valid_max'] = 3
+    ds.severity.attrs['long_name'] = 'Flood level severity (1: medium, 2: high, 3: severe)'
+
+    return ds
+
+def floodEventsFromFile(filename, tile_size=None):
+    ''' Flood event statistics of a flood index file, one band of latitudes at a time
+
+    Args:
+        filename (str): GloFAS_FloodIndex netcdf file
+        tile_size (list): number of latitudes (and longitudes, unused) read at
+            once. Default is the full bounding box.
+
+    Returns:
+        ds (xarray Dataset): see floodEvents
+    '''
+    flood = xr.open_dataset(filename)
+    lat = flood['lat'].values
+    nlat = np.size(lat) if tile_size is None else tile_size[0]
+    bands = []
+    for y0 in range(0, np.size(lat), nlat):
+        band = flood.flood[:, y0:y0+nlat, :]
+        bands.append(floodEvents(band.values, band['lat'].values,
+                                 band['lon'].values, band['time'].values))
+    flood.close()
+
+    return xr.concat(bands, dim='lat')
+
+def writeEvents(ds, time, year, directory='./results'):
+    ''' Write the flood event statistics next to the flood index
+
+    Args:
+        ds (xarray Dataset): flood event statistics, see floodEvents
+        time (numpy array): Vector of time
+        year (int): year of interest
+        directory (str): output directory. Default is ./results
+    '''
+    var_attrs, global_attrs = floodAttributes(ds['lat'].values, ds['lon'].values)
+    ds.attrs.update(global_attrs)
+    ds.attrs['title'] = "Flood Events"
+    ds.attrs['summary'] = 'Flood events (consecutive days with a flood severity index of at least 1)'+\
+        ' in each grid cell: number of events, longest run at or above each severity, onset of'+\
+        ' the first event and peak severity. '+global_attrs['summary']
+    ds.attrs['time_coverage_start'] = str(time[0])
+    ds.attrs['time_coverage_end'] = str(time[-1])
+
+    if os.path.isdir(directory) is False:
+        os.makedirs(directory)
+
+    ds.to_netcdf(directory+'/GloFAS_FloodEvents_'+str(year)+'.nc')
+
+#%% Sparse (event-only) storage
+def createSparse(lat, lon, missing, year, directory='./results'):
+    ''' Create an empty sparse flood index file
+
+    Only the non-zero cells of each day are stored, as one record per cell in
+    the columns day, lat_index, lon_index and flood. Cells missing on every
+    day are flagged once in the missing grid; cells missing on some days only
+    are stored as records with flood=FILL_VALUE. record_offset holds the first
+    record of each day, so a range of days is one contiguous slice of records.
+    The file is filled with appendSparse and finalized with closeNetcdf.
+
+    Args:
+        lat (numpy array): Vector of latitudes
+        lon (numpy array): Vector of longtidues
+        missing (numpy array): boolean lat x lon grid of cells missing on every day
+        year (int): year of interest
+        directory (str): output directory. Default is ./results
+
+    Returns:
+        nc (netCDF4 Dataset): the open output file
+    '''
+    if os.path.isdir(directory) is False:
+        os.makedirs(directory)
+
+    var_attrs, global_attrs = floodAttributes(lat, lon)
+    var_attrs['missing_value'] = np.int8(FILL_VALUE)
+    nc = netCDF4.Dataset(directory+'/GloFAS_FloodRecords_'+str(year)+'.nc', 'w')
+    nc.createDimension('time', None)
+    nc.createDimension('record', None)
+    nc.createDimension('lat', np.size(lat))
+    nc.createDimension('lon', np.size(lon))
+    nc_time = nc.createVariable('time', 'f8', ('time',))
+    nc_time.units = TIME_UNITS
+    nc_time.calendar = 'proleptic_gregorian'
+    nc.createVariable('lat', 'f8', ('lat',))[:] = lat
+    nc.createVariable('lon', 'f8', ('lon',))[:] = lon
+    nc_missing = nc.createVariable('missing', 'i1', ('lat','lon'))
+    nc_missing.long_name = 'Cells without data on every day'
+    nc_missing[:] = missing
+    nc_offset = nc.createVariable('record_offset', 'i8', ('time',))
+    nc_offset.long_name = 'Index of the first record of each day'
+    for name, long_name in [('day', 'Index of the day of the record along time'),
+                            ('lat_index', 'Index of the latitude of the record'),
+                            ('lon_index', 'Index of the longitude of the record')]:
+        column = nc.createVariable(name, 'i4', ('record',), zlib=True, shuffle=True,
+                                   complevel=4, chunksizes=(2**16,))
+        column.long_name = long_name
+    nc_flood = nc.createVariable('flood', 'i1', ('record',), zlib=True, shuffle=True,
+                                 complevel=4, chunksizes=(2**16,))
+    nc_flood.setncatts(var_attrs)
+    nc.setncatts(global_attrs)
+    nc.title = 'Flood Severity (sparse records)'
+    nc.time_coverage_resolution = 'daily'
+
+    return nc
+
+def appendSparse(nc, flood_bool, time):
+    ''' Append days of the flooding index to a file created by createSparse
+
+    Args:
+        nc (netCDF4 Dataset): file created by createSparse
+        flood_bool (numpy array): flood severity index for the days (time x lat x lon)
+        time (numpy array): Vector of time for the days
+    '''
+    missing = nc['missing'][:].astype(bool)
+    day0 = len(nc.dimensions['time'])
+    record0 = len(nc.dimensions['record'])
+    flood_bool = np.asarray(flood_bool)
+    # missing cells are kept as records, except those missing on every day
+    keep = (flood_bool != 0) & ~(np.isnan(flood_bool) & missing)
+    day, ilat, ilon = np.nonzero(keep)
+    severity = np.nan_to_num(flood_bool[day, ilat, ilon], nan=FILL_VALUE).astype('int8')
+    counts = np.bincount(day, minlength=np.shape(flood_bool)[0])
+
+    nc_time = nc['time']
+    nc_time[day0:day0+np.size(time)] = netCDF4.date2num(pd.to_datetime(time).to_pydatetime(),
+                                                        nc_time.units, nc_time.calendar)
+    nc['record_offset'][day0:day0+np.size(time)] = record0+np.cumsum(counts)-counts
+    stop = record0+np.size(day)
+    nc['day'][record0:stop] = day+day0
+    nc['lat_index'][record0:stop] = ilat
+    nc['lon_index'][record0:stop] = ilon
+    nc['flood'][record0:stop] = severity
+
+def writeSparse(flood_bool, lat, lon, time, year, directory='./results'):
+    ''' Write the flooding index as sparse records (see createSparse)
+
+    Args:
+        flood_bool (numpy array): flood severity index (time x lat x lon)
+        lat (numpy array): Vector of latitudes
+        lon (numpy array): Vector of longtidues
+        time (numpy array): Vector of time
+        year (int): year of interest
+        directory (str): output directory. Default is ./results
+
+    Returns:
+        filename (str): path of the GloFAS_FloodRecords_<year>.nc file
+    '''
+    missing = np.all(np.isnan(flood_bool), axis=0)
+    nc = createSparse(lat, lon, missing, year, directory)
+    appendSparse(nc, flood_bool, time)
+    closeNetcdf(nc)
+
+    return directory+'/GloFAS_FloodRecords_'+str(year)+'.nc'
+
+def sparseFromFile(filename, year, chunk_size=30, directory='./results'):
+    ''' Convert a dense flood index file into sparse records, chunk_size days at a time
+
+    Args:
+        filename (str): GloFAS_FloodIndex netcdf file
+        year (int): year of interest
+        chunk_size (int): number of days read at once
+        directory (str): output directory. Default is ./results
+
+    Returns:
+        filename (str): path of the GloFAS_FloodRecords_<year>.nc file
+    '''
+    flood = xr.open_dataset(filename)
+    ntime = flood['time'].size
+    missing = np.ones((flood['lat'].size, flood['lon'].size), dtype=bool)
+    for t0 in range(0, ntime, chunk_size):
+        missing &= np.all(np.isnan(flood.flood[t0:t0+chunk_size].values), axis=0)
+    nc = createSparse(flood['lat'].values, flood['lon'].values, missing, year, directory)
+    for t0 in range(0, ntime, chunk_size):
+        chunk = flood.flood[t0:t0+chunk_size]
+        appendSparse(nc, chunk.values, chunk['time'].values)
+    closeNetcdf(nc)
+    flood.close()
+
+    return directory+'/GloFAS_FloodRecords_'+str(year)+'.nc'
+
+def readSparse(filename, start=None, end=None):
+    ''' Rebuild the dense flooding index of a sparse file for a range of dates
+
+    Only the records of the requested days are read from disk.
+
+    Args:
+        filename (str): GloFAS_FloodRecords netcdf file
+        start (str): first date to read, e.g. '2017-06-01'. Default is the
+            beginning of the file
+        end (str): last date to read (included). Default is the end of the file
+
+    Returns:
+        flood (xarray DataArray): flood severity index (time x lat x lon), as
+            written by writeNetcdf
+    '''
+    nc = netCDF4.Dataset(filename)
+    nc.set_auto_mask(False)
+    nc_time = nc['time']
+    time = np.array(netCDF4.num2date(nc_time[:], nc_time.units, nc_time.calendar,
+                                     only_use_cftime_datetimes=False,
+                                     only_use_python_datetimes=True), dtype='datetime64[ns]')
+    i0 = 0 if start is None else int(np.searchsorted(time, np.datetime64(start, 'ns'), 'left'))
+    i1 = np.size(time) if end is None else int(np.searchsorted(time, np.datetime64(end, 'ns'), 'right'))
+    offsets = np.append(nc['record_offset'][:], len(nc.dimensions['record']))
+    r0, r1 = offsets[i0], offsets[max(i0, i1)]
+
+    lat = nc['lat'][:]
+    lon = nc['lon'][:]
+    flood_bool = np.zeros((max(0, i1-i0), np.size(lat), np.size(lon)))
+    flood_bool[:, nc['missing'][:].astype(bool)] = np.nan
+    severity = nc['flood'][r0:r1].astype('float64')
+    severity[severity == FILL_VALUE] = np.nan
+    flood_bool[nc['day'][r0:r1]-i0, nc['lat_index'][r0:r1], nc['lon_index'][r0:r1]] = severity
+    nc.close()
+
+    var_attrs, global_attrs = floodAttributes(lat, lon)
+    flood = xr.DataArray(flood_bool, coords=[time[i0:i1], lat, lon], dims=['time','lat','lon'])
+    flood.attrs.update(var_attrs)
+
+    return flood
+
+#%% Incremental update
+def newGloFASFiles(path, time_end):
+    ''' GloFAS files of a yearly folder holding days after time_end
+
+    The date is read from the file name when it contains one (YYYYMMDD),
+    otherwise from the time coordinate of the file.
+
+    Args:
+        path (str): yearly GloFAS folder
+        time_end (numpy datetime64): last day already classified
+
+    Returns:
+        file_names (list): files with days after time_end, in time order
+    '''
+    file_names = []
+    for file in sorted(glob.glob(path+'/*.nc')):
+        match = re.search(r'(\d{8})', os.path.basename(file))
+        try:
+            last = np.datetime64(pd.to_datetime(match.group(1), format='%Y%m%d'))
+        except (AttributeError, ValueError):
+            with xr.open_dataset(file) as f:
+                last = f['time'].values.max()
+        if last > time_end:
+            file_names.append(file)
+
+    return file_names
+
+def updateIndex(data, thresholds, year, bounding_box, file_year, cache_dir=None):
+    ''' Classify only the GloFAS days after the end of an existing flood index file
+
+    The last classified day is read from the time_coverage_end attribute of
+    ./results/GloFAS_FloodIndex_<file_year>.nc. Only the newer GloFAS files
+    are opened, and the new days are appended to the file in place.
+
+    Args:
+        data (str): path to GloFAS in netcdf format. Either one file with all
+            years (ending in .nc) or a folder organized in yearly folders
+        thresholds (str): Name of the netcdf file containing the thresholds data
+        year (list or int): years to consider
+        bounding_box (list): min_lon, max_lon, min_lat, max_lat
+        file_year (str or int): year used to name the output file
+        cache_dir (str): directory of the threshold cache, see loadThresholds.
+            Default is None (no disk cache)
+
+    Returns:
+        time (numpy array): time vector of the updated file
+    '''
+    filename = './results/GloFAS_FloodIndex_'+str(file_year)+'.nc'
+    with netCDF4.Dataset(filename) as nc:
+        time_end = np.datetime64(nc.time_coverage_end)
+
+    if data.endswith('.nc')==True:
+        p_ = openGloFAS(data, year, bounding_box)
+    else:
+        file_names = newGloFASFiles(data+'/'+str(year), time_end)
+        p_ = openGloFASFiles(file_names, bounding_box) if len(file_names)>0 else None
+    if p_ is not None:
+        p_ = p_.isel(time=np.nonzero(p_['time'].values>time_end)[0])
+    if p_ is None or np.size(p_['time']) == 0:
+        print('No new GloFAS days after '+str(time_end)+' for '+str(file_year))
+        with xr.open_dataset(filename) as f:
+            return f['time'].values
+
+    Q2, Q5, Q20 = openThresholds(thresholds, bounding_box, cache_dir)
+    lat = p_['lat'].values
+    lon = p_['lon'].values
+    time = p_['time'].values
+    flood_bool = calculateIndex(p_.dis24.values, Q2, Q5, Q20, lat, lon, time)
+    p_.close()
+    print('Appending '+str(np.size(time))+' new days to '+filename)
+
+    nc = netCDF4.Dataset(filename, 'a')
+    if nc.dimensions['time'].isunlimited():
+        appendNetcdf(nc, flood_bool, time)
+        closeNetcdf(nc)
+    else:
+        # older files have a fixed time dimension: rewrite them once
+        nc.close()
+        with xr.open_dataset(filename) as f:
+            old = f.flood.load()
+        compact = old.encoding.get('dtype') == np.dtype('int8')
+        writeNetcdf(np.concatenate([old.values, flood_bool]), lat, lon,
+                    np.concatenate([old['time'].values, time]), file_year, compact)
+
+    with xr.open_dataset(filename) as f:
+        return f['time'].values
+
+#%% Per-year execution
+def processYear(data, thresholds, year, bounding_box, chunk_size=None,
+                tile_size=None, compact=False, events=False, incremental=False,
+                sparse=False, cache_dir=None):
+    ''' Compute and write the flood index for one yearly folder
+
+    Args:
+        data (str): path to GloFAS in netcdf format. Data needs to be oragnized in yearly folders
+        thresholds (str): Name of the netcdf file containing the thresholds data
+        year (int): year to consider
+        bounding_box (list): min_lon, max_lon, min_lat, max_lat
+        chunk_size (int): if set, stream the data in chunks of that many days
+        tile_size (list): spatial tile size used in streaming mode
+        compact (bool): store the index as compressed int8
+        events (bool): also write the flood event statistics (GloFAS_FloodEvents_<year>.nc)
+        incremental (bool): if the year was already computed, only classify
+            the new days (see updateIndex)
+        sparse (bool): store the index as sparse records (GloFAS_FloodRecords_<year>.nc)
+            instead of the dense GloFAS_FloodIndex_<year>.nc
+        cache_dir (str): directory of the threshold cache, see loadThresholds.
+            Default is None (no disk cache)
+
+    Returns:
+        filename (str): path of the GloFAS_FloodIndex_<year>.nc file, or of the
+            GloFAS_FloodRecords_<year>.nc file if sparse
+    '''
+    filename = './results/GloFAS_FloodIndex_'+str(year)+'.nc'
+    if incremental == True and os.path.isfile(filename):
+        time = updateIndex(data, thresholds, year, bounding_box, year, cache_dir)
+        if events == True:
+            writeEvents(floodEventsFromFile(filename, tile_size), time, year)
+    elif chunk_size is None:
+        val, Q2, Q5, Q20, lat, lon, time = openDatasets(data,thresholds,year,bounding_box,cache_dir)
+        flood_bool = calculateIndex(val, Q2, Q5, Q20, lat, lon, time)
+        if sparse == True:
+            filename = writeSparse(flood_bool, lat, lon, time, year)
+        else:
+            writeNetcdf(flood_bool, lat, lon, time, year, compact)
+        if events == True:
+            writeEvents(floodEvents(flood_bool, lat, lon, time), time, year)
+    else:
+        lat, lon, time = calculateIndexChunked(data, thresholds, year, bounding_box, year,
+                                               chunk_size, tile_size, compact, cache_dir)
+        if events == True:
+            writeEvents(floodEventsFromFile(filename, tile_size), time, year)
+        if sparse == True:
+            dense = filename
+            filename = sparseFromFile(dense, year, chunk_size)
+            os.remove(dense)
+
+    return filename
+
+def processYears(data, thresholds, year, bounding_box, workers=1,
+                 chunk_size=None, tile_size=None, compact=False, events=False,
+                 incremental=False, sparse=False, cache_dir=None):
+    ''' Compute and write the flood index for several yearly folders
+
+    Each year is written to its own file, so years are independent and can
+    be processed in a pool of worker processes.
+
+    Args:
+        data (str): path to GloFAS in netcdf format. Data needs to be oragnized in yearly folders
+        thresholds (str): Name of the netcdf file containing the thresholds data
+        year (list): years to consider
+        bounding_box (list): min_lon, max_lon, min_lat, max_lat
+        workers (int): number of worker processes. Default is 1 (no pool)
+        chunk_size (int): if set, stream the data in chunks of that many days
+        tile_size (list): spatial tile size used in streaming mode
+        compact (bool): store the index as compressed int8
+        events (bool): also write the flood event statistics of each year
+        incremental (bool): only classify the days missing from existing yearly files
+        sparse (bool): store the index of each year as sparse records
+        cache_dir (str): directory of the threshold cache, see loadThresholds.
+            Default is None (no disk cache)
+
+    Returns:
+        filenames (list): paths of the yearly files, in the order of year
+    '''
+    if os.path.isdir('./results') is False:
+        os.makedirs('./results')
+    # fill the threshold cache once, before the workers read it
+    loadThresholds(thresholds, bounding_box, cache_dir)
+
+    n = len(year)
+    args = ([data]*n, [thresholds]*n, year, [bounding_box]*n,
+            [chunk_size]*n, [tile_size]*n, [compact]*n, [events]*n, [incremental]*n, [sparse]*n,
+            [cache_dir]*n)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, n)) as executor:
+            filenames = list(executor.map(processYear, *args))
+    else:
+        filenames = list(map(processYear, *args))
+
+    return filenames
+
+#%% Multi-region batch mode
+def readRegions(regions):
+    ''' Named bounding boxes for the multi-region batch mode
+
+    Args:
+        regions (dict or str): either a dictionary of name: [min_lon, max_lon,
+            min_lat, max_lat], or the path to a json file containing such a
+            dictionary, or to a GeoJSON FeatureCollection. The bounding box of
+            each feature is used, named after its 'name' property.
+
+    Returns:
+        regions (dict): name: bounding box
+    '''
+    if isinstance(regions, dict):
+        return regions
+    with open(regions) as f:
+        content = json.load(f)
+    if content.get('type') != 'FeatureCollection':
+        return content
+
+    boxes = {}
+    for i, feature in enumerate(content['features']):
+        coords = np.array(list(flattenCoordinates(feature['geometry']['coordinates'])))
+        name = (feature.get('properties') or {}).get('name', 'region_'+str(i))
+        boxes[str(name)] = [np.min(coords[:,0]), np.max(coords[:,0]),
+                            np.min(coords[:,1]), np.max(coords[:,1])]
+
+    return boxes
+
+def flattenCoordinates(coords):
+    ''' Yield the (lon, lat) positions of nested GeoJSON coordinates '''
+    if isinstance(coords[0], (int, float)):
+        yield coords[:2]
+    else:
+        for c in coords:
+            yield from flattenCoordinates(c)
+
+def regionSlices(lat, lon, bounding_box):
+    ''' Index slices of a bounding box in the union grid
+
+    Uses the same (inclusive) selection as the .sel in openGloFAS.
+
+    Args:
+        lat (numpy array): latitude vector of the union grid
+        lon (numpy array): longitude vector of the union grid
+        bounding_box (list): min_lon, max_lon, min_lat, max_lat
+
+    Returns:
+        lat_slice, lon_slice (slice): indices of the region
+    '''
+    y = np.nonzero((lat>=bounding_box[2]) & (lat<=bounding_box[3]))[0]
+    x = np.nonzero((lon>=bounding_box[0]) & (lon<=bounding_box[1]))[0]
+    if np.size(y) == 0 or np.size(x) == 0:
+        raise ValueError('Region '+str(bounding_box)+' does not overlap the GloFAS grid')
+
+    return slice(y[0], y[-1]+1), slice(x[0], x[-1]+1)
+
+def calculateIndexRegions(data, thresholds, year, regions, file_year,
+                          chunk_size=30, compact=False, cache_dir=None):
+    ''' Flood index of several regions from one read of GloFAS
+
+    Each time chunk of dis24 is read once over the union of the regions,
+    classified once, and the slice of each region is appended to its own
+    file in ./results/<name>.
+
+    Args:
+        data (str): path to GloFAS in netcdf format. Either one file with all
+            years (ending in .nc) or a folder organized in yearly folders
+        thresholds (str): Name of the netcdf file containing the thresholds data
+        year (list or int): years to consider
+        regions (dict): name: bounding box, see readRegions
+        file_year (str or int): year used to name the output files
+        chunk_size (int): number of days read at once
+        compact (bool): store the index as compressed int8
+        cache_dir (str): directory of the threshold cache, see loadThresholds.
+            Default is None (no disk cache)
+
+    Returns:
+        time (numpy array): time vector
+    '''
+    boxes = np.array(list(regions.values()), dtype=float)
+    union = [np.min(boxes[:,0]), np.max(boxes[:,1]), np.min(boxes[:,2]), np.max(boxes[:,3])]
+    p_ = openGloFAS(data, year, union)
+    Q2, Q5, Q20 = openThresholds(thresholds, union, cache_dir)
+    lat = p_['lat'].values
+    lon = p_['lon'].values
+    time = p_['time'].values
+
+    outputs = {}
+    for name, bounding_box in regions.items():
+        y_, x_ = regionSlices(lat, lon, bounding_box)
+        outputs[name] = (y_, x_, createNetcdf(lat[y_], lon[x_], file_year, compact,
+                                              './results/'+str(name)))
+    for t0 in range(0, np.size(time), chunk_size):
+        t_ = slice(t0, t0+chunk_size)
+        val = p_.dis24[t_].values
+        flood_bool = calculateIndex(val, Q2, Q5, Q20, lat, lon, time[t_])
+        for name, (y_, x_, nc) in outputs.items():
+            appendNetcdf(nc, flood_bool[:, y_, x_], time[t_])
+    for name, (y_, x_, nc) in outputs.items():
+        closeNetcdf(nc)
+    p_.close()
+
+    return time
+
+def processRegions(data, thresholds, year, regions, workers=1, chunk_size=30,
+                   compact=False, events=False, cache_dir=None):
+    ''' Compute and write the flood index of several regions
+
+    Args:
+        data (str): path to GloFAS in netcdf format. Either one file with all
+            years (ending in .nc) or a folder organized in yearly folders
+        thresholds (str): Name of the netcdf file containing the thresholds data
+        year (list): years to consider
+        regions (dict): name: bounding box, see readRegions
+        workers (int): number of years processed in parallel (yearly folders only)
+        chunk_size (int): number of days read at once
+        compact (bool): store the index as compressed int8
+        events (bool): also write the flood event statistics
+        cache_dir (str): directory of the threshold cache, see loadThresholds.
+            Default is None (no disk cache)
+
+    Returns:
+        filenames (dict): name: list of flood index files of the region
+    '''
+    if data.endswith('.nc')==True:
+        runs = [(year, 'all')]
+    else:
+        runs = [(y, y) for y in year]
+
+    n = len(runs)
+    args = ([data]*n, [thresholds]*n, [r[0] for r in runs], [regions]*n,
+            [r[1] for r in runs], [chunk_size]*n, [compact]*n, [cache_dir]*n)
+    if workers > 1 and n > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, n)) as executor:
+            times = list(executor.map(calculateIndexRegions, *args))
+    else:
+        times = list(map(calculateIndexRegions, *args))
+
+    filenames = {}
+    for name in regions:
+        directory = './results/'+str(name)
+        filenames[name] = [directory+'/GloFAS_FloodIndex_'+str(file_year)+'.nc'
+                           for y, file_year in runs]
+        if events == True:
+            for (y, file_year), time, filename in zip(runs, times, filenames[name]):
+                writeEvents(floodEventsFromFile(filename), time, file_year, directory)
+
+    return filenames
 
-def visualizeFlood(allflood, lat, lon, alltime):
+#%% Visualization
+FLOOD_LEVELS = [0,1,2,3,4]
+FLOOD_COLORS = ['white','orange','#FF4500','#B22222']
+
+def floodFigure(lat, lon):
+    ''' Draw the flood map without the index, see drawFloodFrame
+
+    Args:
+        lat (numpy array): latitude vector
+        lon (numpy array): longitude vector
+
+    Returns:
+        frame (dict): figure, axes, title and background of the map
+    '''
     proj = ccrs.PlateCarree()
+    fig,ax = plt.subplots(figsize=[15,10])
+    ax = plt.axes(projection=proj)
+    ax.add_feature(cfeature.BORDERS)
+    ax.add_feature(cfeature.COASTLINE)
+    ax.add_feature(cfeature.RIVERS)
+    # zero contour, removed once the extent and colorbar are set
+    img = plt.contourf(lon, lat, np.zeros((np.size(lat),np.size(lon))), FLOOD_LEVELS,
+        colors = FLOOD_COLORS,
+        transform=proj)
+    cbar = plt.colorbar(img, orientation='horizontal',pad=0.1)
+    cbar.ax.set_title('Flood Severity Index')
+    cbar.ax.set_xticklabels(['None','Medium','High','Severe',''])
+    gl = ax.gridlines(crs=ccrs.PlateCarree(), draw_labels=True,
+                  linewidth=2, color='gray', alpha=0.5, linestyle='--')
+    gl.xlabels_top = False
+    gl.ylabels_right = False
+    gl.xlines = False
+    gl.ylines = False
+    gl.xlocator = mticker.FixedLocator(np.linspace(np.round(np.min(lon)),np.round(np.max(lon)),5))
+    gl.ylocator = mticker.FixedLocator(np.linspace(np.round(np.min(lat)),np.round(np.max(lat)),5))
+    gl.xformatter = LONGITUDE_FORMATTER
+    gl.yformatter = LATITUDE_FORMATTER
+    gl.xlabel_style = {'size': 12, 'color': 'gray'}
+    gl.ylabel_style = {'size': 12, 'color': 'gray'}
+    # blank title, set to the date of each day by drawFloodFrame
+    title = plt.title(' ', fontsize=18, loc='left', pad=1)
+    zorder = contourArtists(img)[0].get_zorder()
+    for c in contourArtists(img):
+        c.remove()
+    overlay = sorted([a for a in ax.get_children() if a.get_zorder()>zorder],
+                     key=lambda a: a.get_zorder())
+    for a in overlay:
+        a.set_animated(True)
+    fig.canvas.draw()
+
+    frame = {'fig': fig,
+             'ax': ax,
+             'proj': proj,
+             'title': title,
+             'overlay': overlay,
+             'background': fig.canvas.copy_from_bbox(fig.bbox)}
+
+    return frame
+
+def contourArtists(img):
+    ''' List of the artists of a contourf plot '''
+    if isinstance(img, matplotlib.artist.Artist):
+        return [img]
+    return img.collections
+
+def drawFloodFrame(frame, v, date, lat, lon):
+    ''' Draw the flood index of one day over the static map
+
+    Args:
+        frame (dict): map created by floodFigure
+        v (numpy array): flood index for the day (lat x lon)
+        date (str): date used as the title
+        lat (numpy array): latitude vector
+        lon (numpy array): longitude vector
+
+    Returns:
+        rgb (numpy array): the rendered frame (height x width x 3)
+    '''
+    fig = frame['fig']
+    ax = frame['ax']
+    fig.canvas.restore_region(frame['background'])
+    img = ax.contourf(lon, lat, v, FLOOD_LEVELS,
+        colors = FLOOD_COLORS,
+        transform=frame['proj'])
+    frame['title'].set_text(date)
+    for a in contourArtists(img)+frame['overlay']:
+        ax.draw_artist(a)
+    rgb = np.array(fig.canvas.buffer_rgba())[:,:,:3]
+    for c in contourArtists(img):
+        c.remove()
+
+    return rgb
+
+# map of the current worker process, see initFloodWorker
+worker_frame = None
+
+def initFloodWorker(lat, lon):
+    ''' Draw the static map once in each rendering process '''
+    global worker_frame
+    worker_frame = {'frame': floodFigure(lat, lon), 'lat': lat, 'lon': lon}
+
+def renderFloodFrame(v, date):
+    ''' Render one day with the map of the current process '''
+    return drawFloodFrame(worker_frame['frame'], v, date,
+                          worker_frame['lat'], worker_frame['lon'])
+
+def visualizeFlood(allflood, lat, lon, alltime, workers=1, save_frames=False):
+    ''' Make a movie of the flood index in ./results/Flooding_index.mp4
+
+    Args:
+        allflood (numpy array or xarray DataArray): flood index (time x lat x lon).
+            A lazy DataArray is read one day at a time.
+        lat (numpy array): latitude vector
+        lon (numpy array): longitude vector
+        alltime (numpy array): time vector
+        workers (int): number of processes rendering frames. Default is 1 (no pool)
+        save_frames (bool): also save each frame as a jpeg in ./figures
+    '''
     idx = np.size(alltime)
-    count = list(np.arange(0,idx,1))
-    filenames =[]
+    dates = [pd.to_datetime(t).strftime("%d %B %Y") for t in alltime]
 
     #Make a directory for results/figures if it doesn't exit
-    if os.path.isdir('./figures') is False:
+    if save_frames == True and os.path.isdir('./figures') is False:
         os.makedirs('./figures')
     if os.path.isdir('./results') is False:
         os.makedirs('./results')
-    
-    for i in count:
-        v = allflood[i,:,:]
-        date = pd.to_datetime(alltime[i]).strftime("%d %B %Y")  
-        fig,ax = plt.subplots(figsize=[15,10])
-        ax = plt.axes(projection=proj)
-        ax.add_feature(cfeature.BORDERS)
-        ax.add_feature(cfeature.COASTLINE)
-        ax.add_feature(cfeature.RIVERS)
-        img = plt.contourf(lon, lat, v, [0,1,2,3,4],
-            colors = ['white','orange','#FF4500','#B22222'],               
-            transform=proj)
-        cbar = plt.colorbar(img, orientation='horizontal',pad=0.1)
-        cbar.ax.set_title('Flood Severity Index')
-        cbar.ax.set_xticklabels(['None','Medium','High','Severe',''])
-        gl = ax.gridlines(crs=ccrs.PlateCarree(), draw_labels=True,
-                      linewidth=2, color='gray', alpha=0.5, linestyle='--')
-        gl.xlabels_top = False
-        gl.ylabels_right = False
-        gl.xlines = False
-        gl.ylines = False
-        gl.xlocator = mticker.FixedLocator(np.linspace(np.round(np.min(lon)),np.round(np.max(lon)),5))
-        gl.ylocator = mticker.FixedLocator(np.linspace(np.round(np.min(lat)),np.round(np.max(lat)),5))
-        gl.xformatter = LONGITUDE_FORMATTER
-        gl.yformatter = LATITUDE_FORMATTER
-        gl.xlabel_style = {'size': 12, 'color': 'gray'}
-        gl.ylabel_style = {'size': 12, 'color': 'gray'}
-        #Add a title with time
-        plt.title(date, fontsize=18, loc='left', pad=1)
-        #save a jepg
-        filename = './figures/flooding_t'+str(date)+'.jpeg'
-        filenames.append(filename)
-        plt.savefig(filename)
-        plt.close(fig)
-    
-    #create a gif
+
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=initFloodWorker,
+                                       initargs=(lat, lon))
+        render = executor.map
+    else:
+        executor = None
+        initFloodWorker(lat, lon)
+        render = map
+
+    #create the movie, a few frames per worker are in flight at a time
     writer = imageio.get_writer('./results/Flooding_index.mp4', fps=5)
-    for filename in filenames:
-        writer.append_data(imageio.imread(filename))
+    batch = 4*max(workers, 1)
+    for i0 in range(0, idx, batch):
+        days = range(i0, min(i0+batch, idx))
+        frames = [np.asarray(allflood[i,:,:]) for i in days]
+        for i, rgb in zip(days, render(renderFloodFrame, frames, dates[i0:i0+batch])):
+            writer.append_data(rgb)
+            if save_frames == True:
+                imageio.imwrite('./figures/flooding_t'+dates[i]+'.jpeg', rgb)
     writer.close()
-    
+
+    if executor is not None:
+        executor.shutdown()
+    else:
+        plt.close(worker_frame['frame']['fig'])
+
+def parseBoundingBox(text):
+    ''' Parse the bounding box argument: a literal, or the path to a regions file '''
+    if os.path.isfile(text):
+        return text
+    return ast.literal_eval(text)
+
 if __name__ == "__main__":
     #params
-    bounding_box = ast.literal_eval(sys.argv[3])
-    year = ast.literal_eval(sys.argv[4])
-    thresholds = sys.argv[2]
-    data = sys.argv[1]
-    fig = ast.literal_eval(sys.argv[5])
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data", type=str, help="GloFAS file (.nc) or folder of yearly folders")
+    parser.add_argument("thresholds", type=str, help="netcdf file containing the thresholds")
+    parser.add_argument("bounding_box", type=parseBoundingBox,
+                        help="[min_lon,max_lon,min_lat,max_lat], or for several regions a dictionary "+\
+                        "of name: bounding box, or a json/GeoJSON file of regions")
+    parser.add_argument("year", type=ast.literal_eval, help="list of years")
+    parser.add_argument("fig", type=ast.literal_eval, help="True to make the movie")
+    parser.add_argument("--chunk", type=int, default=None,
+                        help="stream GloFAS in chunks of this many days instead of loading it at once")
+    parser.add_argument("--tile", type=int, nargs=2, default=None, metavar=("NLAT","NLON"),
+                        help="spatial tile size used with --chunk")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of years (and movie frames) processed in parallel")
+    parser.add_argument("--compact", action="store_true",
+                        help="store the index as compressed int8 instead of float64")
+    parser.add_argument("--events", action="store_true",
+                        help="also write flood event statistics (GloFAS_FloodEvents_<year>.nc)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only classify the GloFAS days after the end of existing output files")
+    parser.add_argument("--sparse", action="store_true",
+                        help="store only the non-zero cells (GloFAS_FloodRecords_<year>.nc) "+\
+                        "instead of the dense index")
+    parser.add_argument("--cache", type=str, default=None, metavar="DIR",
+                        help="keep the thresholds cut to the bounding box in DIR, so that later"+\
+                        " runs over the same region memory-map them (default: no disk cache)")
+    parser.add_argument("--frames", action="store_true",
+                        help="also save each movie frame as a jpeg in ./figures")
+    options = parser.parse_args()
+    if options.sparse == True and options.incremental == True:
+        parser.error('--incremental updates the dense index and cannot be combined with --sparse')
+    if isinstance(options.bounding_box, (dict, str)):
+        for flag in ['incremental', 'sparse', 'tile']:
+            if getattr(options, flag) not in (None, False):
+                parser.error('--'+flag+' is not supported for several regions')
+    bounding_box = options.bounding_box
+    year = options.year
+    thresholds = options.thresholds
+    data = options.data
+    fig = options.fig
 
     #Run the functions in a row
-    if data.endswith('.nc')==True:
-        val, Q2, Q5, Q20, lat, lon, time = openDataset(data,thresholds,year,bounding_box)
-        flood_bool = calculateIndex(val, Q2, Q5, Q20, lat, lon, time)
-        writeNetcdf(flood_bool, lat, lon, time, 'all')
+    if isinstance(bounding_box, (dict, str)):
+        regions = readRegions(bounding_box)
+        processRegions(data, thresholds, year, regions, options.workers,
+                       options.chunk or 30, options.compact, options.events, options.cache)
         if fig == True:
-            visualizeFlood(flood_bool, lat, lon, time)
+            print("Visualization is not supported for several regions")
 
-    else:    
-        for y in year:
-            val, Q2, Q5, Q20, lat, lon, time = openDatasets(data,thresholds,y,bounding_box)
+    elif data.endswith('.nc')==True:
+        if options.incremental == True and os.path.isfile('./results/GloFAS_FloodIndex_all.nc'):
+            time = updateIndex(data, thresholds, year, bounding_box, 'all', options.cache)
+            if options.events == True:
+                ds = floodEventsFromFile('./results/GloFAS_FloodIndex_all.nc', options.tile)
+                writeEvents(ds, time, 'all')
+            if fig == True:
+                ds = xr.open_dataset('./results/GloFAS_FloodIndex_all.nc')
+                visualizeFlood(ds.flood, ds.lat.values, ds.lon.values, ds.time.values,
+                               options.workers, options.frames)
+        elif options.chunk is None:
+            val, Q2, Q5, Q20, lat, lon, time = openDataset(data,thresholds,year,bounding_box,options.cache)
             flood_bool = calculateIndex(val, Q2, Q5, Q20, lat, lon, time)
-            writeNetcdf(flood_bool, lat, lon, time, y)
-            if fig  == True:
-                try: allflood = np.concatenate((allflood,flood_bool),axis=0)
-                except NameError: allflood = flood_bool
-                try: alltime = np.concatenate((alltime,time),axis=0)
-                except NameError: alltime = time
-    
+            if options.sparse == True:
+                writeSparse(flood_bool, lat, lon, time, 'all')
+            else:
+                writeNetcdf(flood_bool, lat, lon, time, 'all', options.compact)
+            if options.events == True:
+                writeEvents(floodEvents(flood_bool, lat, lon, time), time, 'all')
+            if fig == True:
+                visualizeFlood(flood_bool, lat, lon, time,
+                               options.workers, options.frames)
+        else:
+            lat, lon, time = calculateIndexChunked(data, thresholds, year, bounding_box, 'all',
+                                                   options.chunk, options.tile, options.compact,
+                                                   options.cache)
+            if options.events == True:
+                ds = floodEventsFromFile('./results/GloFAS_FloodIndex_all.nc', options.tile)
+                writeEvents(ds, time, 'all')
             if fig == True:
-                visualizeFlood(allflood, lat, lon, alltime)
+                ds = xr.open_dataset('./results/GloFAS_FloodIndex_all.nc')
+                visualizeFlood(ds.flood, ds.lat.values, ds.lon.values, ds.time.values,
+                               options.workers, options.frames)
+                ds.close()
+            if options.sparse == True:
+                sparseFromFile('./results/GloFAS_FloodIndex_all.nc', 'all', options.chunk)
+                os.remove('./results/GloFAS_FloodIndex_all.nc')
+
+    else:
+        filenames = processYears(data, thresholds, year, bounding_box,
+                                 options.workers, options.chunk, options.tile,
+                                 options.compact, options.events, options.incremental,
+                                 options.sparse, options.cache)
+        if fig == True:
+            if options.sparse == True:
+                flood = xr.concat([readSparse(f) for f in filenames], dim='time')
+            else:
+                # lazy view over the yearly files, frames are read one at a time
+                flood = xr.open_mfdataset(filenames).flood
+            visualizeFlood(flood, flood.lat.values, flood.lon.values, flood.time.values,
+                           options.workers, options.frames)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Build the flood thresholds used by FloodSeverityIndex.py.
+
+Fits a Gumbel extreme value distribution to the yearly maxima of the GloFAS
+discharge in each grid cell and returns the discharge for the requested
+return periods. All the grid cells are fitted at once with array operations.
+"""
+import argparse
+import ast
+import os
+from datetime import date
+
+import numpy as np
+import xarray as xr
+
+from FloodSeverityIndex import openGloFAS
+
+EULER_GAMMA = 0.5772156649015329
+
+def annualMaxima(data, years, bounding_box):
+    ''' Yearly maxima of the GloFAS discharge in each grid cell
+
+    The data is read one year at a time, so only one year is in memory.
+
+    Args:
+        data (str): path to GloFAS in netcdf format. Either one file with all
+            years (ending in .nc) or a folder organized in yearly folders
+        years (list): years to consider
+        bounding_box (list): min_lon, max_lon, min_lat, max_lat
+
+    Returns:
+        qmax (numpy array): yearly maxima (year x lat x lon). NaN when a cell
+            has no data for the year.
+        lat (numpy array): latitude vector
+        lon (numpy array): longitude vector
+    '''
+    qmax = []
+    for y in years:
+        if data.endswith('.nc')==True:
+            p_ = openGloFAS(data, [y], bounding_box)
+        else:
+            p_ = openGloFAS(data, y, bounding_box)
+        if np.size(p_['time']) == 0:
+            print('No data for year '+str(y)+', skipping')
+            continue
+        qmax.append(p_.dis24.max('time').values)
+        lat = p_['lat'].values
+        lon = p_['lon'].values
+        p_.close()
+
+    return np.stack(qmax), lat, lon
+
+def fitGumbel(qmax, method='mle', iterations=50, tol=1e-10):
+    ''' Fit a Gumbel distribution to the yearly maxima of every cell at once
+
+    The method of moments gives the starting point. With method='mle' the
+    maximum likelihood scale is then found with Newton iterations, run on
+    all the cells together (same estimator as scipy.stats.gumbel_r.fit).
+
+    Args:
+        qmax (numpy array): yearly maxima (year x lat x lon), NaN for missing years
+        method (str): 'mle' (maximum likelihood) or 'moments'
+        iterations (int): maximum number of Newton iterations
+        tol (float): convergence tolerance on the standardized scale
+
+    Returns:
+        mu (numpy array): location of the Gumbel distribution (lat x lon)
+        beta (numpy array): scale of the Gumbel distribution (lat x lon). 0
+            for the cells that cannot be fitted (constant maxima, e.g. no flow)
+    '''
+    assert method == 'mle' or method == 'moments', "Valid entries for method are 'mle' or 'moments'"
+
+    valid = np.isfinite(qmax)
+    n = np.sum(valid, axis=0)
+    x = np.where(valid, qmax, 0.)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.sum(x, axis=0)/n
+        std = np.sqrt(np.sum(np.where(valid, (x-mean)**2, 0.), axis=0)/n)
+    # cells with at least two different values can be fitted
+    fit = (n>1) & (std>0)
+    scale = np.where(fit, std, 1.)
+    # standardized maxima, to keep the exponentials in range
+    z = np.where(valid, (x-mean)/scale, 0.)
+
+    b = np.full(np.shape(mean), np.sqrt(6)/np.pi)
+    if method == 'mle':
+        # the cells without data (e.g. the ocean) give 0/0, they are not fitted
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for i in range(iterations):
+                e = np.where(valid, np.exp(-z/b), 0.)
+                B = np.sum(e, axis=0)
+                A = np.sum(z*e, axis=0)/B
+                C = np.sum(z*z*e, axis=0)/B
+                # root of b + A(b) = mean(z) = 0
+                f = b + A
+                df = 1 + (C-A**2)/b**2
+                step = np.where(fit, f/df, 0.)
+                b = np.maximum(b-step, b/10)
+                if np.nanmax(np.abs(step)) < tol:
+                    break
+        e = np.where(valid, np.exp(-z/b), 0.)
+        with np.errstate(divide='ignore'):
+            m = -b*np.log(np.sum(e, axis=0)/np.maximum(n, 1))
+    else:
+        m = -EULER_GAMMA*b
+
+    beta = np.where(fit, b*scale, 0.)
+    mu = np.where(fit, m*scale+mean, mean)
+
+    return mu, beta
+
+def returnLevel(mu, beta, period):
+    ''' Discharge exceeded on average once every period years
+
+    Cells that could not be fitted (beta <= 0, e.g. constant or zero flow)
+    have no threshold: all their return levels would be equal, so every day
+    would be classified as a severe flood. They are set to NaN, the missing
+    thresholds that calculateIndex never flags as a flood.
+
+    Args:
+        mu (numpy array): location of the Gumbel distribution
+        beta (numpy array): scale of the Gumbel distribution
+        period (float): return period in years
+
+    Returns:
+        Q (numpy array): threshold discharge, NaN where beta <= 0
+    '''
+    with np.errstate(invalid='ignore'):
+        return np.where(beta > 0, mu-beta*np.log(-np.log(1-1/period)), np.nan)
+
+def writeThresholds(mu, beta, lat, lon, periods, years, filename):
+    ''' Write the thresholds in the format read by FloodSeverityIndex.py
+
+    The thresholds of the cells that could not be fitted are NaN (see
+    returnLevel).
+
+    Args:
+        mu (numpy array): location of the Gumbel distribution
+        beta (numpy array): scale of the Gumbel distribution
+        lat (numpy array): Vector of latitudes
+        lon (numpy array): Vector of longtidues
+        periods (list): return periods in years, written as Q_<period>
+        years (list): years used for the fit
+        filename (str): name of the output netcdf file
+    '''
+    ds = xr.Dataset(coords={'lat': lat, 'lon': lon})
+    names = []
+    for period in periods:
+        name = 'Q_'+('%g' % period)
+        names.append('%g' % period+'-yr')
+        Q = returnLevel(mu, beta, period)
+        ds[name] = (('lat','lon'), Q)
+        ds[name].attrs['title'] = 'Threshold volumetric flow rate (m3/s) for a '+('%g' % period)+'-yr flood'
+        ds[name].attrs['long_name'] = 'Threshold volumetric flow rate (m3/s)'
+        ds[name].attrs['units'] = 'm3/s'
+        ds[name].attrs['valid_min'] = np.nanmin(Q)
+        ds[name].attrs['valid_max'] = np.nanmax(Q)
+    ds['mu'] = (('lat','lon'), mu)
+    ds['mu'].attrs['title'] = 'Location of the Gumbel distribution'
+    ds['mu'].attrs['long_name'] = 'mu'
+    ds['mu'].attrs['units'] = 'm3/s'
+    ds['mu'].attrs['valid_min'] = np.nanmin(mu)
+    ds['mu'].attrs['valid_max'] = np.nanmax(mu)
+    ds['beta'] = (('lat','lon'), beta)
+    ds['beta'].attrs['title'] = 'Scale of the Gumbel distribution'
+    ds['beta'].attrs['long_name'] = 'beta'
+    ds['beta'].attrs['units'] = 'm3/s'
+    ds['beta'].attrs['valid_min'] = np.nanmin(beta)
+    ds['beta'].attrs['valid_max'] = np.nanmax(beta)
+
+    period = str(np.min(years))+'-'+str(np.max(years))
+    ds.attrs['title'] = 'Threshold volumetric discharge for '+', '.join(names)+' flood'
+    ds.attrs['summary'] = 'Threshold volumetric discharge for '+', '.join(names)+\
+        ' flood inferred from the GloFAS dataset over the '+period+' period.'+\
+        ' The thresholds were determined by fitting a Gumbel extreme value'+\
+        ' distribution to the yearly maxima in each grid cell.'
+    ds.attrs['date_created'] = str(date.today())
+    ds.attrs['creator_name'] = 'Deborah Khider'
+    ds.attrs['creator_email'] = 'khider@usc.edu'
+    ds.attrs['institution'] = 'USC Information Sciences Institute'
+    ds.attrs['geospatial_lat_min'] = np.min(lat)
+    ds.attrs['geospatial_lat_max'] = np.max(lat)
+    ds.attrs['geospatial_lon_min'] = np.min(lon)
+    ds.attrs['geospatial_lon_max'] = np.max(lon)
+
+    if os.path.dirname(filename) != '' and os.path.isdir(os.path.dirname(filename)) is False:
+        os.makedirs(os.path.dirname(filename))
+    ds.to_netcdf(filename)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data", type=str, help="GloFAS file (.nc) or folder of yearly folders")
+    parser.add_argument("bounding_box", type=ast.literal_eval, help="[min_lon,max_lon,min_lat,max_lat]")
+    parser.add_argument("start_year", type=int, help="first year of the fit")
+    parser.add_argument("end_year", type=int, help="last year of the fit")
+    parser.add_argument("--periods", type=float, nargs='+', default=[2,5,20],
+                        help="return periods in years (default: 2 5 20)")
+    parser.add_argument("--method", type=str, default='mle', choices=['mle','moments'],
+                        help="Gumbel fitting method")
+    parser.add_argument("--output", type=str, default='./results/GloFAS_FloodThreshold.nc',
+                        help="output netcdf file")
+    options = parser.parse_args()
+
+    years = list(range(options.start_year, options.end_year+1))
+    qmax, lat, lon = annualMaxima(options.data, years, options.bounding_box)
+    mu, beta = fitGumbel(qmax, options.method)
+    writeThresholds(mu, beta, lat, lon, options.periods, years, options.output)
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the flood severity index, on the synthetic data of FSI_benchmark.py.
+
+Run with: python -m pytest -q test_FloodSeverityIndex.py
+"""
+import numpy as np
+import pytest
+import xarray as xr
+
+from FloodSeverityIndex import calculateIndex, calculateIndexChunked, openDataset
+from FSI_benchmark import calculateIndexLoop, syntheticData, writeSynthetic
+
+@pytest.mark.parametrize('nan_fraction, seed', [(0., 0), (0.1, 1), (0.5, 2)])
+def test_classifier_matches_loop(nan_fraction, seed):
+    '''The np.select classifier is bit-identical to the loop version, including
+    on the thresholds and with missing discharge or thresholds'''
+    args = syntheticData(12, 17, 23, nan_fraction, seed)
+    ref = calculateIndexLoop(*args)
+    new = calculateIndex(*args)
+
+    assert new.dtype == ref.dtype
+    assert np.array_equal(new, ref, equal_nan=True)
+
+@pytest.mark.filterwarnings('error::RuntimeWarning')
+def test_compact_chunked_write(tmp_path, monkeypatch):
+    '''A compact (int8) streamed run writes the same index as the in-memory
+    classifier, without casting NaN to int8'''
+    monkeypatch.chdir(tmp_path)
+    data, thresholds, year, bounding_box = writeSynthetic(str(tmp_path), 20, 12, 15)
+    val, Q2, Q5, Q20, lat, lon, time = openDataset(data, thresholds, year, bounding_box)
+    expected = calculateIndex(val, Q2, Q5, Q20, lat, lon, time)
+
+    calculateIndexChunked(data, thresholds, year, bounding_box, 'all', chunk_size=7,
+                          tile_size=[5, 6], compact=True)
+    with xr.open_dataset(str(tmp_path/'results'/'GloFAS_FloodIndex_all.nc')) as ds:
+        flood = ds.flood.values
+
+    assert np.any(np.isnan(expected))
+    assert np.array_equal(flood, expected, equal_nan=True)